@@ -2,17 +2,95 @@ import discord
 from discord.ext import commands, tasks
 import asyncio
 import json
+import re
 import os
+import heapq
+import bisect
+import sqlite3
+import shutil
 from datetime import datetime, timedelta
 import pytz
 from typing import List, Optional
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 import io
+import gzip
+import time
+import functools
+import contextvars
+import math
+import base64
+import sys
+import tracemalloc
+from array import array
+from collections import OrderedDict, deque
 
 # Bot setup
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+STARTED_AT = time.monotonic()
+
+# SHARD_COUNT=auto (or a number) runs an AutoShardedBot instead of a single
+# gateway connection. With a number, SHARD_IDS ("0-3" or "0,2,5") limits this
+# process to those shards, so a large deployment can run one process per
+# shard range; each process only loads and saves the guilds it owns.
+def parse_shard_ids(value: str) -> Optional[tuple]:
+    shard_ids = set()
+    for part in filter(None, value.replace(' ', '').split(',')):
+        first, _, last = part.partition('-')
+        shard_ids.update(range(int(first), int(last or first) + 1))
+    return tuple(sorted(shard_ids)) or None
+
+SHARD_COUNT = os.getenv('SHARD_COUNT', '').lower()
+SHARDED = bool(SHARD_COUNT)
+SHARD_COUNT = int(SHARD_COUNT) if SHARD_COUNT.isdigit() else None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+    return (guild_id >> 22) % shard_count
+
+def owns_guild(guild_id: int) -> bool:
+    """Whether this process's shards receive the guild's events"""
+    return SHARD_IDS is None or shard_for(guild_id, SHARD_COUNT) in SHARD_IDS
+
+class ModsenseBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    """Bot whose @bot.event/@bot.command handlers are instrumented, serving /health and /metrics"""
+
+    async def setup_hook(self):
+        self.health_server = await start_health_server()
+        self.loop_lag_task = asyncio.create_task(monitor_loop_lag())
+
+    def event(self, coro):
+        return super().event(instrument(coro.__name__)(coro))
+
+    def command(self, name: str = discord.utils.MISSING, *args, **kwargs):
+        decorator = super().command(name, *args, **kwargs)
+        
+        def instrumented(func):
+            return decorator(instrument(f"command:{name or func.__name__}")(func))
+        return instrumented
+
+# INTENT_PROFILE=full subscribes to every intent and caches every member before
+# ready (the original behaviour). 'minimal' subscribes only to what the handlers
+# use - no presences, typing or voice states - and chunks member lists after
+# ready, in the background, instead of holding up startup for them.
+INTENT_PROFILE = os.getenv('INTENT_PROFILE', 'full').lower()
+
+def gateway_options(profile: str) -> dict:
+    if profile != 'minimal':
+        return {'intents': discord.Intents.all()}
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.moderation = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.from_intents(intents),
+        'chunk_guilds_at_startup': False
+    }
+
+shard_options = {'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS} if SHARDED else {}
+bot = ModsenseBot(command_prefix='!', help_command=None, **gateway_options(INTENT_PROFILE), **shard_options)
 
 # Configuration
 GUILD_ID = 1403359962369097739
@@ -24,6 +102,63 @@ HIGHER_STAFF_PING_ROLE = 1410422656112791592
 RCACHE_ROLES = [1410422029236047975, 1410422762895577088, 1406326282429403306]
 DANGEROUS_LOG_USERS = [1406326282429403306, 1410422762895577088, 1410422029236047975]
 MOD_ROLES = [1410422029236047975, 1410422762895577088]
+GUILD_CONFIG_FILE = os.getenv('GUILD_CONFIG_FILE', 'guilds.json')
+GUILD_DATA_DIR = 'guilds'
+
+class GuildConfig:
+    """Ids of the channels, roles and users the bot works with in one guild"""
+    __slots__ = ('guild_id', 'tracking_channel_id', 'mute_log_channel_id', 'mute_role_id', 'staff_ping_role',
+                 'higher_staff_ping_role', 'rcache_roles', 'dangerous_log_users', 'mod_roles', 'data_dir')
+
+    def __init__(self, guild_id: int, tracking_channel_id: int, mute_log_channel_id: int, mute_role_id: int,
+                 staff_ping_role: int, higher_staff_ping_role: int, rcache_roles: list, dangerous_log_users: list,
+                 mod_roles: list, data_dir: str = None):
+        self.guild_id = guild_id
+        self.tracking_channel_id = tracking_channel_id
+        self.mute_log_channel_id = mute_log_channel_id
+        self.mute_role_id = mute_role_id
+        self.staff_ping_role = staff_ping_role
+        self.higher_staff_ping_role = higher_staff_ping_role
+        self.rcache_roles = set(rcache_roles)
+        self.dangerous_log_users = list(dangerous_log_users)
+        self.mod_roles = set(mod_roles)
+        # The original guild keeps its data files in the working directory
+        if data_dir is None:
+            data_dir = '' if guild_id == GUILD_ID else os.path.join(GUILD_DATA_DIR, str(guild_id))
+        self.data_dir = data_dir
+
+    @classmethod
+    def from_json(cls, guild_id: int, value: dict):
+        return cls(
+            guild_id, value['tracking_channel_id'], value['mute_log_channel_id'], value['mute_role_id'],
+            value['staff_ping_role'], value['higher_staff_ping_role'], value.get('rcache_roles', []),
+            value.get('dangerous_log_users', []), value.get('mod_roles', []), value.get('data_dir')
+        )
+
+def load_guild_configs() -> dict:
+    configs = {
+        GUILD_ID: GuildConfig(
+            GUILD_ID, TRACKING_CHANNEL_ID, MUTE_LOG_CHANNEL_ID, MUTE_ROLE_ID, STAFF_PING_ROLE,
+            HIGHER_STAFF_PING_ROLE, RCACHE_ROLES, DANGEROUS_LOG_USERS, MOD_ROLES
+        )
+    }
+    if os.path.exists(GUILD_CONFIG_FILE):
+        with open(GUILD_CONFIG_FILE, 'r') as f:
+            for guild_id, value in json.load(f).items():
+                configs[int(guild_id)] = GuildConfig.from_json(int(guild_id), value)
+    return configs
+
+guild_configs = load_guild_configs()
+
+def guild_config(guild: Optional[discord.Guild]) -> Optional[GuildConfig]:
+    """Config for an event's guild; DMs fall back to the original guild.
+
+    Guilds on another process's shards have no config here, so DMs are only
+    handled (and the original guild's data only opened) by the process that
+    owns the original guild.
+    """
+    guild_id = guild.id if guild else GUILD_ID
+    return guild_configs.get(guild_id) if owns_guild(guild_id) else None
 
 # Timezones for display
 TIMEZONES = {
@@ -33,275 +168,3247 @@ TIMEZONES = {
     'JST': pytz.timezone('Asia/Tokyo')
 }
 
+# Stored times are integer epoch seconds; ISO strings written by older
+# versions are converted as they are loaded
+def epoch_seconds(value) -> Optional[int]:
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=pytz.utc)
+    return int(parsed.timestamp())
+
+# Metrics
+# Prometheus-style metrics served from the bot's own event loop
+METRICS_PORT = int(os.getenv('PORT', '8080'))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.counts):
+            self.counts[position] += 1
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_label_value(value)}"' for key, value in labels) + "}"
+
+class MetricsRegistry:
+    """Counters, histograms and callback gauges keyed by (name, labels)"""
+
+    def __init__(self):
+        self._help = {}
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def _declare(self, name: str, kind: str, help_text: str):
+        self._types.setdefault(name, kind)
+        self._help.setdefault(name, help_text)
+
+    def inc(self, name: str, help_text: str, value: float = 1, **labels):
+        self._declare(name, 'counter', help_text)
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram(self, name: str, help_text: str, **labels) -> Histogram:
+        self._declare(name, 'histogram', help_text)
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, name: str, help_text: str, value: float, **labels):
+        self.histogram(name, help_text, **labels).observe(value)
+
+    def gauge(self, name: str, help_text: str, callback, by: str = None, **labels):
+        """Register a gauge whose value is read from `callback` at scrape time.
+        With `by`, the callback returns {label value: value}, one sample each."""
+        self._declare(name, 'gauge', help_text)
+        self._gauges[(name, tuple(sorted(labels.items())))] = (callback, by)
+
+    def render(self) -> str:
+        samples = {}
+        for (name, labels), value in self._counters.items():
+            samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (callback, by) in self._gauges.items():
+            try:
+                value = callback()
+            except Exception:
+                continue
+            lines = samples.setdefault(name, [])
+            if by is None:
+                lines.append(f"{name}{_labels(labels)} {value}")
+            else:
+                lines.extend(f"{name}{_labels(labels + ((by, key),))} {item}" for key, item in sorted(value.items()))
+        for (name, labels), histogram in self._histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        
+        out = []
+        for name in sorted(samples):
+            out.append(f"# HELP {name} {self._help[name]}")
+            out.append(f"# TYPE {name} {self._types[name]}")
+            out.extend(samples[name])
+        return "\n".join(out) + "\n"
+
+metrics = MetricsRegistry()
+
+def record_save(kind: str, start: float, payload):
+    metrics.observe('bot_save_seconds', "Time to prepare and write a save", time.perf_counter() - start, kind=kind)
+    if isinstance(payload, (bytes, bytearray)):
+        metrics.inc('bot_save_bytes_total', "Bytes written by saves", len(payload), kind=kind)
+    else:
+        metrics.inc('bot_save_rows_total', "Rows written by SQLite saves", len(payload), kind=kind)
+
+def instrument_http(http):
+    """Count and time every REST call by route template and outcome"""
+    original = http.request
+
+    async def request(route, **kwargs):
+        route_label = f"{route.method} {route.path}"
+        outcome = 'ok'
+        start = time.perf_counter()
+        try:
+            return await original(route, **kwargs)
+        except discord.HTTPException as e:
+            outcome = str(e.status)
+            raise
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.inc('discord_rest_requests_total', "REST calls by route and outcome", route=route_label, outcome=outcome)
+            metrics.observe('discord_rest_request_seconds', "REST call latency by route", elapsed, route=route_label)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.add_rest(route_label, elapsed)
+
+    http.request = request
+
+instrument_http(bot.http)
+
+# Handler tracing: every event, command and task loop runs under a trace that
+# splits its wall time into time awaiting REST calls and time spent running
+# on the event loop (sync time, which is what stalls everything else).
+SLOW_HANDLER_SECONDS = float(os.getenv('SLOW_HANDLER_SECONDS', '0.25'))
+SLOW_TRACE_LIMIT = 50
+TRACE_MAX_CALLS = 20
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+slow_traces = deque(maxlen=SLOW_TRACE_LIMIT)
+
+class HandlerTrace:
+    __slots__ = ('name', 'parent', 'active', 'rest', 'sync', 'calls')
+
+    def __init__(self, name: str, parent: Optional['HandlerTrace']):
+        self.name = name
+        self.parent = parent
+        self.active = True
+        self.rest = 0.0
+        self.sync = 0.0
+        self.calls = []
+
+    def add_rest(self, route: str, seconds: float):
+        # Background tasks inherit the context of the handler that spawned them,
+        # so calls made after that handler finished are not charged to it
+        trace = self
+        while trace is not None and trace.active:
+            trace.rest += seconds
+            if len(trace.calls) < TRACE_MAX_CALLS:
+                trace.calls.append((route, seconds))
+            trace = trace.parent
+
+class _SteppedCoroutine:
+    """Awaitable that drives a coroutine one step at a time, adding the time
+    spent inside each step to the trace's sync time"""
+    __slots__ = ('coro', 'trace')
+
+    def __init__(self, coro, trace: HandlerTrace):
+        self.coro = coro
+        self.trace = trace
+
+    def __await__(self):
+        send, throw, trace = self.coro.send, self.coro.throw, self.trace
+        value = None
+        error = None
+        while True:
+            start = time.perf_counter()
+            try:
+                future = throw(error) if error is not None else send(value)
+            except StopIteration as stop:
+                trace.sync += time.perf_counter() - start
+                return stop.value
+            except BaseException:
+                trace.sync += time.perf_counter() - start
+                raise
+            trace.sync += time.perf_counter() - start
+            try:
+                value = yield future
+                error = None
+            except BaseException as e:
+                value = None
+                error = e
+
+def instrument(name: str):
+    """Decorator recording wall/rest/sync histograms and slow traces for a coroutine function"""
+    help_text = "Handler time by phase (wall, rest = awaiting REST calls, sync = running on the loop)"
+    
+    def decorator(func):
+        wall_histogram = metrics.histogram('bot_handler_seconds', help_text, handler=name, phase='wall')
+        rest_histogram = metrics.histogram('bot_handler_seconds', help_text, handler=name, phase='rest')
+        sync_histogram = metrics.histogram('bot_handler_seconds', help_text, handler=name, phase='sync')
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            trace = HandlerTrace(name, current_trace.get())
+            token = current_trace.set(trace)
+            start = time.perf_counter()
+            try:
+                return await _SteppedCoroutine(func(*args, **kwargs), trace)
+            finally:
+                wall = time.perf_counter() - start
+                trace.active = False
+                current_trace.reset(token)
+                wall_histogram.observe(wall)
+                rest_histogram.observe(trace.rest)
+                sync_histogram.observe(trace.sync)
+                if wall >= SLOW_HANDLER_SECONDS:
+                    slow_traces.append({
+                        'handler': name,
+                        'at': datetime.now(pytz.utc).isoformat(),
+                        'wall': round(wall, 4),
+                        'rest': round(trace.rest, 4),
+                        'sync': round(trace.sync, 4),
+                        'calls': [(route, round(seconds, 4)) for route, seconds in trace.calls]
+                    })
+        return wrapper
+    return decorator
+
+_loop_lag = 0.0
+
+def gateway_latency() -> Optional[float]:
+    # bot.latency is NaN until the first heartbeat (and the shard average when sharded)
+    return None if math.isnan(bot.latency) else bot.latency
+
+def shard_latencies() -> dict:
+    pairs = bot.latencies if SHARDED else [(bot.shard_id or 0, bot.latency)]
+    return {shard_id: latency for shard_id, latency in pairs if not math.isnan(latency)}
+
+def shard_status() -> dict:
+    """{shard id: {'guilds', 'latency', 'connected'}} for the shards this process runs"""
+    status = {}
+    for shard_id in (bot.shards if SHARDED else [bot.shard_id or 0]):
+        status[shard_id] = {'guilds': 0, 'latency': None, 'connected': bot.is_ready()}
+        if SHARDED:
+            status[shard_id]['connected'] = not bot.shards[shard_id].is_closed()
+    for shard_id, latency in shard_latencies().items():
+        if shard_id in status:
+            status[shard_id]['latency'] = latency
+    for guild in bot.guilds:
+        if guild.shard_id in status:
+            status[guild.shard_id]['guilds'] += 1
+    return status
+
+async def monitor_loop_lag():
+    """Measure how late the event loop wakes a short sleep"""
+    global _loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _loop_lag = max(0.0, loop.time() - expected)
+        metrics.observe('bot_event_loop_lag_seconds', "Event loop wake-up delay", _loop_lag)
+
+# Startup milestones (time since the process started and RSS at that point),
+# so the intent profiles can be compared from /health or the logs
+startup_report = {'profile': INTENT_PROFILE}
+
+def resident_memory() -> Optional[int]:
+    """Resident set size in bytes, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def report_startup(milestone: str):
+    if milestone in startup_report:
+        return
+    seconds = time.monotonic() - STARTED_AT
+    rss = resident_memory()
+    startup_report[milestone] = {'seconds': round(seconds, 3), 'rss_bytes': rss}
+    memory = f", RSS {rss / 2 ** 20:.0f} MB" if rss else ""
+    print(f"⏱️ {milestone} after {seconds:.1f}s ({INTENT_PROFILE} profile{memory})")
+
+def register_gauges():
+    metrics.gauge('bot_event_loop_lag_last_seconds', "Most recent event loop wake-up delay", lambda: _loop_lag)
+    metrics.gauge('discord_gateway_latency_seconds', "Gateway heartbeat latency", lambda: gateway_latency() or 0)
+    metrics.gauge('discord_shard_latency_seconds', "Gateway heartbeat latency per shard", shard_latencies, by='shard')
+    metrics.gauge('discord_shard_guilds', "Guilds per shard", lambda: {shard_id: s['guilds'] for shard_id, s in shard_status().items()}, by='shard')
+    metrics.gauge('discord_shard_connected', "1 while the shard's gateway connection is open", lambda: {shard_id: int(s['connected']) for shard_id, s in shard_status().items()}, by='shard')
+    metrics.gauge('bot_ready', "1 once the gateway session is ready", lambda: int(bot.is_ready()))
+    metrics.gauge('process_resident_memory_bytes', "Resident memory size", lambda: resident_memory() or 0)
+    metrics.gauge('bot_startup_seconds', "Time from process start to each startup milestone", lambda: {
+        milestone: value['seconds'] for milestone, value in startup_report.items() if isinstance(value, dict)
+    }, by='milestone')
+    metrics.gauge('bot_guilds_loaded', "Guilds whose data is loaded", lambda: len(guild_states.loaded()))
+    metrics.gauge('bot_users_tracked', "User records in bot data", lambda: _guild_total(lambda s: len(s.data['users'])))
+    metrics.gauge('bot_active_mutes', "Active mutes", lambda: _guild_total(lambda s: len(s.data['mutes'])))
+    metrics.gauge('bot_pending_unmutes', "Unmutes waiting in the scheduler", lambda: _guild_total(lambda s: len(s.unmutes)))
+    metrics.gauge('bot_cases', "Moderation cases held in memory", lambda: _guild_total(lambda s: len(s.data['cases'])))
+    metrics.gauge('bot_activity_blocks', "Per-user day blocks of activity history", lambda: _guild_total(lambda s: len(s.data['activity'])))
+    metrics.gauge('bot_online_tracked_members', "Members with a tracking role", lambda: _guild_total(lambda s: len(s.activity.tracked)))
+    metrics.gauge('bot_cache_entries', "Entries per in-memory cache", lambda: _guild_total(lambda s: len(s.data['cached_messages'])), cache='messages')
+    metrics.gauge('bot_cache_entries', "Entries per in-memory cache", lambda: len(user_resolver), cache='users')
+    metrics.gauge('bot_cache_entries', "Entries per in-memory cache", lambda: len(audit_tail), cache='audit_log')
+    metrics.gauge('bot_queue_depth', "Items waiting per background queue", lambda: _guild_total(lambda s: len(s.log_queue)), queue='log')
+    metrics.gauge('bot_queue_depth', "Items waiting per background queue", lambda: len(dm_queue), queue='dm')
+    metrics.gauge('bot_pending_changes', "Keys marked dirty and not yet flushed", lambda: _guild_total(GuildState.pending_changes))
+
+def _guild_total(value) -> int:
+    return sum(value(state) for state in guild_states.loaded())
+
+register_gauges()
+
+# Health endpoint
+async def handle_home(request):
+    return web.Response(text="✅ Discord Bot is running!")
+
+async def handle_health(request):
+    return web.json_response({
+        "status": "healthy" if bot.is_ready() else "starting",
+        "bot": str(bot.user) if bot.user else "starting",
+        "gateway_latency": gateway_latency(),
+        "loop_lag": _loop_lag,
+        "shards": {str(shard_id): s for shard_id, s in shard_status().items()},
+        "startup": startup_report
+    })
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def handle_traces(request):
+    return web.json_response(list(reversed(slow_traces)))
+
+async def start_health_server():
+    app = web.Application()
+    app.router.add_get('/', handle_home)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/traces', handle_traces)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', METRICS_PORT).start()
+    return runner
+
+# Message cache
+# The ring buffer needs at least one slot
+MESSAGE_CACHE_SIZE = max(1, int(os.getenv('MESSAGE_CACHE_SIZE', '2000')))
+TOKEN_RE = re.compile(r"\w+")
+
+class CachedMessage:
+    """Compact record of a message seen by the bot"""
+    __slots__ = ('id', 'author_id', 'author_name', 'content', 'attachments', 'embeds',
+                 'channel_id', 'timestamp', 'reference', 'created_at')
+
+    def __init__(self, id: int, author_id: int, author_name: str, content: str, attachments: list,
+                 embeds: int, channel_id: int, timestamp: int, reference: Optional[int], created_at: int):
+        self.id = id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.attachments = attachments
+        self.embeds = embeds
+        self.channel_id = channel_id
+        self.timestamp = timestamp
+        self.reference = reference
+        self.created_at = created_at
+
+    @classmethod
+    def from_message(cls, message: discord.Message):
+        return cls(
+            message.id,
+            message.author.id,
+            str(message.author),
+            message.content,
+            [att.url for att in message.attachments],
+            len(message.embeds),
+            message.channel.id,
+            int(time.time()),
+            message.reference.message_id if message.reference else None,
+            int(message.created_at.timestamp())
+        )
+
+    @classmethod
+    def from_json(cls, value):
+        if isinstance(value, dict):
+            # Layout used before the ring buffer, with full embed dicts
+            msg = cls(
+                value['id'], value.get('author_id'), value.get('author_name'), value.get('content'),
+                value.get('attachments', []), len(value.get('embeds', [])), value.get('channel_id'),
+                value.get('timestamp'), value.get('reference'), value.get('created_at')
+            )
+        else:
+            msg = cls(*value)
+        msg.timestamp = epoch_seconds(msg.timestamp)
+        msg.created_at = epoch_seconds(msg.created_at)
+        return msg
+
+    def to_json(self) -> list:
+        return [getattr(self, field) for field in self.__slots__]
+
+    def tokens(self) -> set:
+        """Search terms: words of the content, attachment URLs and author name"""
+        text = " ".join((self.content or '', *self.attachments, self.author_name or ''))
+        return set(TOKEN_RE.findall(text.lower()))
+
+class MessageCache:
+    """Fixed-capacity ring buffer of cached messages.
+
+    Messages are indexed by id (slot lookup) and by channel and author. The
+    secondary indexes are deques in insertion order, so an evicted message
+    is always at the left end of its channel/author deque. An inverted
+    index maps each search token to the ids of the messages containing it.
+    """
+
+    def __init__(self, capacity: int = MESSAGE_CACHE_SIZE):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._next = 0
+        self._size = 0
+        self._by_id = {}
+        self._by_channel = {}
+        self._by_author = {}
+        self._by_token = {}
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        start = (self._next - self._size) % self.capacity
+        for i in range(self._size):
+            yield self._slots[(start + i) % self.capacity]
+
+    def append(self, msg: CachedMessage) -> Optional[CachedMessage]:
+        """Add a message, returning the one it evicted (if any)"""
+        slot = self._by_id.get(msg.id)
+        if slot is not None:
+            self._unindex_tokens(self._slots[slot])
+            self._slots[slot] = msg
+            self._index_tokens(msg)
+            return None
+
+        evicted = self._slots[self._next]
+        if evicted is not None:
+            self._unindex(evicted)
+        else:
+            self._size += 1
+
+        self._slots[self._next] = msg
+        self._by_id[msg.id] = self._next
+        self._by_channel.setdefault(msg.channel_id, deque()).append(msg.id)
+        self._by_author.setdefault(msg.author_id, deque()).append(msg.id)
+        self._index_tokens(msg)
+        self._next = (self._next + 1) % self.capacity
+        return evicted
+
+    def _index_tokens(self, msg: CachedMessage):
+        for token in msg.tokens():
+            self._by_token.setdefault(token, set()).add(msg.id)
+
+    def _unindex_tokens(self, msg: CachedMessage):
+        for token in msg.tokens():
+            ids = self._by_token[token]
+            ids.discard(msg.id)
+            if not ids:
+                del self._by_token[token]
+
+    def _unindex(self, msg: CachedMessage):
+        del self._by_id[msg.id]
+        self._unindex_tokens(msg)
+        for index, key in ((self._by_channel, msg.channel_id), (self._by_author, msg.author_id)):
+            ids = index[key]
+            ids.popleft()
+            if not ids:
+                del index[key]
+
+    def get(self, message_id: int) -> Optional[CachedMessage]:
+        slot = self._by_id.get(message_id)
+        return self._slots[slot] if slot is not None else None
+
+    def oldest(self) -> Optional[CachedMessage]:
+        if not self._size:
+            return None
+        return self._slots[(self._next - self._size) % self.capacity]
+
+    def recent(self, limit: int) -> List[CachedMessage]:
+        """Newest `limit` messages, oldest first"""
+        count = min(limit, self._size)
+        return [self._slots[(self._next - count + i) % self.capacity] for i in range(count)]
+
+    def _from_index(self, ids: Optional[deque], limit: Optional[int]) -> List[CachedMessage]:
+        if not ids:
+            return []
+        if limit is not None:
+            ids = list(ids)[-limit:]
+        return [self._slots[self._by_id[message_id]] for message_id in ids]
+
+    def for_channel(self, channel_id: int, limit: int = None) -> List[CachedMessage]:
+        return self._from_index(self._by_channel.get(channel_id), limit)
+
+    def for_author(self, author_id: int, limit: int = None) -> List[CachedMessage]:
+        return self._from_index(self._by_author.get(author_id), limit)
+
+    def search(self, query: str, author_id: int = None, channel_id: int = None, after: datetime = None,
+               before: datetime = None, limit: int = 10):
+        """(total matches, newest matching messages) for messages containing every query token"""
+        tokens = set(TOKEN_RE.findall(query.lower()))
+        if not tokens:
+            return 0, []
+        postings = sorted((self._by_token.get(token, set()) for token in tokens), key=len)
+        ids = set(postings[0]).intersection(*postings[1:]) if postings[0] else set()
+        
+        # Snowflake ids carry their creation time
+        low = discord.utils.time_snowflake(after) if after else None
+        high = discord.utils.time_snowflake(before, high=True) if before else None
+        matches = []
+        for message_id in sorted(ids, reverse=True):
+            if (low is not None and message_id < low) or (high is not None and message_id > high):
+                continue
+            msg = self._slots[self._by_id[message_id]]
+            if author_id is not None and msg.author_id != author_id:
+                continue
+            if channel_id is not None and msg.channel_id != channel_id:
+                continue
+            matches.append(msg)
+        return len(matches), matches[:limit]
+
+    def to_json(self) -> list:
+        return [msg.to_json() for msg in self]
+
+    @classmethod
+    def from_json(cls, rows: list, capacity: int = MESSAGE_CACHE_SIZE):
+        cache = cls(capacity)
+        for row in rows[-capacity:]:
+            cache.append(CachedMessage.from_json(row))
+        return cache
+
+# Activity history
+# Online time is kept per user per UTC day at three resolutions: a minute
+# bitmap (1440 bits) for recent days, 24 hourly minute counts, and a daily
+# total. Older days are downsampled in place as they age out of each tier.
+MINUTE_RETENTION_DAYS = int(os.getenv('MINUTE_RETENTION_DAYS', '14'))
+HOURLY_RETENTION_DAYS = int(os.getenv('HOURLY_RETENTION_DAYS', '90'))
+DAILY_RETENTION_DAYS = int(os.getenv('DAILY_RETENTION_DAYS', '730'))
+HISTORY_MAX_DAYS_SHOWN = 31
+MINUTES_PER_DAY = 1440
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+class DayBlock:
+    """One user's online minutes for one UTC day"""
+    __slots__ = ('bitmap', 'hourly', 'minutes')
+
+    def __init__(self, bitmap: Optional[bytearray] = None, hourly: Optional[array] = None, minutes: int = 0):
+        self.bitmap = bitmap
+        self.hourly = hourly
+        self.minutes = minutes
+
+    @classmethod
+    def new(cls):
+        return cls(bytearray(MINUTES_PER_DAY // 8), array('H', [0] * 24), 0)
+
+    def mark(self, first: int, last: int) -> int:
+        """Mark minutes first..last (inclusive) online, returning how many were new"""
+        if self.bitmap is None:
+            return 0
+        added = 0
+        for minute in range(first, last + 1):
+            byte, bit = divmod(minute, 8)
+            if not self.bitmap[byte] >> bit & 1:
+                self.bitmap[byte] |= 1 << bit
+                self.hourly[minute // 60] += 1
+                added += 1
+        self.minutes += added
+        return added
+
+    def count(self, first: int, last: int) -> float:
+        """Online minutes within first..last, estimated once the day is downsampled"""
+        if first == 0 and last == MINUTES_PER_DAY - 1:
+            return self.minutes
+        if self.bitmap is not None:
+            mask = ((1 << (last - first + 1)) - 1) << first
+            return (int.from_bytes(self.bitmap, 'little') & mask).bit_count()
+        if self.hourly is not None:
+            total = 0
+            for hour in range(first // 60, last // 60 + 1):
+                overlap = min(last, hour * 60 + 59) - max(first, hour * 60) + 1
+                total += self.hourly[hour] * overlap / 60
+            return total
+        return self.minutes * (last - first + 1) / MINUTES_PER_DAY
+
+    def to_json(self) -> list:
+        bitmap = base64.b64encode(self.bitmap).decode() if self.bitmap is not None else None
+        hourly = list(self.hourly) if self.hourly is not None else None
+        return [bitmap, hourly, self.minutes]
+
+    @classmethod
+    def from_json(cls, value: list):
+        bitmap, hourly, minutes = value
+        return cls(
+            bytearray(base64.b64decode(bitmap)) if bitmap is not None else None,
+            array('H', hourly) if hourly is not None else None,
+            minutes
+        )
+
+def day_ordinal(ts: float) -> int:
+    return EPOCH_ORDINAL + int(ts // 86400)
+
+class ActivityHistory:
+    """Per-user day blocks plus a day -> users index for "who was online" queries.
+
+    Blocks are persisted individually under the key "<user_id>:<day ordinal>"
+    so a flush only writes the days that changed.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._by_day = {}
+        self._retained_through = None
+
+    def __len__(self):
+        return sum(len(days) for days in self._users.values())
+
+    @staticmethod
+    def block_key(user_id: int, day: int) -> str:
+        return f"{user_id}:{day}"
+
+    def get_block(self, key: str) -> Optional[DayBlock]:
+        user_id, day = map(int, key.split(':'))
+        return self._users.get(user_id, {}).get(day)
+
+    def set_block(self, key: str, block: Optional[DayBlock]):
+        user_id, day = map(int, key.split(':'))
+        if block is None:
+            self._drop(user_id, day)
+            return
+        self._users.setdefault(user_id, {})[day] = block
+        self._by_day.setdefault(day, set()).add(user_id)
+
+    def _drop(self, user_id: int, day: int):
+        days = self._users.get(user_id)
+        if days is None or days.pop(day, None) is None:
+            return
+        if not days:
+            del self._users[user_id]
+        users = self._by_day[day]
+        users.discard(user_id)
+        if not users:
+            del self._by_day[day]
+
+    def record(self, user_id: int, start: float, end: float) -> list:
+        """Mark every minute touched by the interval [start, end) as online;
+        returns the keys of the blocks that changed"""
+        changed = []
+        if end <= start:
+            return changed
+        first = int(start // 60)
+        last = max(first, -int(-end // 60) - 1)
+        while first <= last:
+            day_first = first - first % MINUTES_PER_DAY
+            day_last = min(last, day_first + MINUTES_PER_DAY - 1)
+            day = EPOCH_ORDINAL + day_first // MINUTES_PER_DAY
+            days = self._users.setdefault(user_id, {})
+            block = days.get(day)
+            if block is None:
+                block = days[day] = DayBlock.new()
+                self._by_day.setdefault(day, set()).add(user_id)
+            if block.mark(first - day_first, day_last - day_first):
+                changed.append(self.block_key(user_id, day))
+            first = day_last + 1
+        return changed
+
+    def _spans(self, start: datetime, end: datetime):
+        """(day, first minute, last minute) for each day overlapping [start, end)"""
+        first = int(start.timestamp() // 60)
+        last = -int(-end.timestamp() // 60) - 1
+        while first <= last:
+            day_first = first - first % MINUTES_PER_DAY
+            day_last = min(last, day_first + MINUTES_PER_DAY - 1)
+            yield EPOCH_ORDINAL + day_first // MINUTES_PER_DAY, first - day_first, day_last - day_first
+            first = day_last + 1
+
+    def minutes_between(self, user_id: int, start: datetime, end: datetime) -> int:
+        days = self._users.get(user_id, {})
+        total = 0
+        for day, first, last in self._spans(start, end):
+            block = days.get(day)
+            if block is not None:
+                total += block.count(first, last)
+        return round(total)
+
+    def daily_totals(self, user_id: int, start: datetime, end: datetime) -> list:
+        """[(date, minutes)] for each UTC day overlapping [start, end)"""
+        days = self._users.get(user_id, {})
+        totals = []
+        for day, first, last in self._spans(start, end):
+            block = days.get(day)
+            totals.append((datetime.fromordinal(day).date(), round(block.count(first, last)) if block else 0))
+        return totals
+
+    def online_between(self, start: datetime, end: datetime) -> list:
+        """[(user_id, minutes)] for everyone online during [start, end), most active first"""
+        totals = {}
+        for day, first, last in self._spans(start, end):
+            for user_id in self._by_day.get(day, ()):
+                minutes = self._users[user_id][day].count(first, last)
+                if minutes:
+                    totals[user_id] = totals.get(user_id, 0) + minutes
+        ranked = sorted(totals.items(), key=lambda x: x[1], reverse=True)
+        return [(user_id, round(minutes)) for user_id, minutes in ranked if round(minutes)]
+
+    def apply_retention(self, today: int) -> list:
+        """Downsample days that aged out of a tier since the last run;
+        returns the keys of the blocks that changed"""
+        changed = []
+        previous = self._retained_through
+        self._retained_through = today
+        tiers = (
+            (today - MINUTE_RETENTION_DAYS, 'bitmap'),
+            (today - HOURLY_RETENTION_DAYS, 'hourly'),
+            (today - DAILY_RETENTION_DAYS, None)
+        )
+        for cutoff, field in tiers:
+            since = previous - (today - cutoff) if previous is not None else None
+            for day in [day for day in self._by_day if day < cutoff and (since is None or day >= since)]:
+                for user_id in list(self._by_day.get(day, ())):
+                    block = self._users[user_id][day]
+                    if field is None:
+                        self._drop(user_id, day)
+                    elif getattr(block, field) is not None:
+                        setattr(block, field, None)
+                    else:
+                        continue
+                    changed.append(self.block_key(user_id, day))
+        return changed
+
+    def days(self) -> list:
+        return list(self._by_day)
+
+    def day_blocks(self, day: int) -> dict:
+        """{user_id: block} for one day"""
+        return {user_id: self._users[user_id][day] for user_id in self._by_day.get(day, ())}
+
+    def copy(self):
+        """Copy of the indexes (blocks are shared) that a worker thread can encode"""
+        history = ActivityHistory()
+        history._users = {user_id: dict(days) for user_id, days in self._users.items()}
+        return history
+
+    def to_json(self) -> dict:
+        return {
+            str(user_id): {str(day): block.to_json() for day, block in days.items()}
+            for user_id, days in self._users.items()
+        }
+
+    @classmethod
+    def from_json(cls, value: dict):
+        history = cls()
+        for user_id, days in value.items():
+            for day, block in days.items():
+                history.set_block(f"{user_id}:{day}", DayBlock.from_json(block))
+        return history
+
+# Moderation cases
+def reason_tokens(reason: Optional[str]) -> set:
+    return set(TOKEN_RE.findall((reason or '').lower()))
+
+class Case:
+    """One mute, identified by its case id"""
+    __slots__ = ('id', 'moderator_id', 'user_id', 'user_name', 'reason', 'duration', 'timestamp')
+
+    def __init__(self, id: int, moderator_id: int, user_id: int, user_name: Optional[str], reason: Optional[str],
+                 duration: Optional[int], timestamp: int):
+        self.id = id
+        self.moderator_id = moderator_id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.reason = reason
+        self.duration = duration
+        self.timestamp = timestamp
+
+    def to_json(self) -> list:
+        return [getattr(self, field) for field in self.__slots__]
+
+    @classmethod
+    def from_json(cls, row):
+        case = cls(*row)
+        case.timestamp = epoch_seconds(case.timestamp)
+        return case
+
+class CaseStore:
+    """Moderation cases indexed by moderator, target and reason token.
+
+    Case ids are handed out in time order, so every index is a sorted id
+    list and a time range maps to an id range with one bisect.
+    """
+
+    def __init__(self):
+        self._cases = {}
+        self._ids = []
+        self._times = []
+        self._by_moderator = {}
+        self._by_user = {}
+        self._by_token = {}
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for case_id in self._ids:
+            yield self._cases[case_id]
+
+    def new_case(self, moderator_id: int, user_id: int, user_name: Optional[str], reason: Optional[str],
+                 duration: Optional[int], timestamp: int) -> Case:
+        case = Case(self.next_id, moderator_id, user_id, user_name, reason, duration, timestamp)
+        self.next_id += 1
+        return case
+
+    def add(self, case: Case):
+        if case.id in self._cases:
+            return
+        self._cases[case.id] = case
+        position = bisect.bisect(self._ids, case.id)
+        self._ids.insert(position, case.id)
+        self._times.insert(position, case.timestamp)
+        bisect.insort(self._by_moderator.setdefault(case.moderator_id, []), case.id)
+        bisect.insort(self._by_user.setdefault(case.user_id, []), case.id)
+        for token in reason_tokens(case.reason):
+            bisect.insort(self._by_token.setdefault(token, []), case.id)
+        self.next_id = max(self.next_id, case.id + 1)
+
+    def get(self, case_id: int) -> Optional[Case]:
+        return self._cases.get(case_id)
+
+    def query(self, moderator_id: int = None, user_id: int = None, tokens: tuple = (), since: datetime = None,
+              until: datetime = None, min_duration: int = None, max_duration: int = None,
+              offset: int = 0, limit: int = 10):
+        """(total matches, matching cases newest first from `offset`)"""
+        lists = []
+        if moderator_id is not None:
+            lists.append(self._by_moderator.get(moderator_id, []))
+        if user_id is not None:
+            lists.append(self._by_user.get(user_id, []))
+        for token in tokens:
+            lists.append(self._by_token.get(token, []))
+        if not lists:
+            lists.append(self._ids)
+        lists.sort(key=len)
+        
+        # Time range -> id range, then narrow the smallest index to it
+        low = bisect.bisect_left(self._times, since.timestamp()) if since else 0
+        high = bisect.bisect_right(self._times, until.timestamp()) if until else len(self._ids)
+        if low >= high:
+            return 0, []
+        base = lists[0]
+        start = bisect.bisect_left(base, self._ids[low])
+        end = bisect.bisect_right(base, self._ids[high - 1])
+        
+        others = lists[1:]
+        if not others and min_duration is None and max_duration is None:
+            page_end = max(start, end - offset)
+            page = base[max(start, page_end - limit):page_end]
+            return end - start, [self._cases[case_id] for case_id in reversed(page)]
+        
+        if start == end:
+            return 0, []
+        low_id, high_id = base[start], base[end - 1]
+        ids = set(base[start:end])
+        for other in others:
+            ids.intersection_update(other[bisect.bisect_left(other, low_id):bisect.bisect_right(other, high_id)])
+        matches = []
+        for case_id in sorted(ids, reverse=True):
+            duration = self._cases[case_id].duration or 0
+            if min_duration is not None and duration < min_duration:
+                continue
+            if max_duration is not None and duration > max_duration:
+                continue
+            matches.append(self._cases[case_id])
+        return len(matches), matches[offset:offset + limit]
+
+    def to_json(self) -> list:
+        return [case.to_json() for case in self]
+
+    @classmethod
+    def from_json(cls, rows: list):
+        store = cls()
+        for row in rows:
+            store.add(Case.from_json(row))
+        return store
+
+def legacy_mute_rows(mute_history: dict, user_mute_history: dict) -> list:
+    """Rows for the old per-moderator and per-user mute lists, which hold every mute twice"""
+    rows = []
+    seen = set()
+    for moderator_id, mutes in mute_history.items():
+        for mute in mutes:
+            seen.add((int(moderator_id), int(mute['user_id']), mute['timestamp']))
+            rows.append((
+                int(moderator_id), int(mute['user_id']), mute.get('user_name'),
+                mute.get('reason'), mute.get('duration'), epoch_seconds(mute['timestamp'])
+            ))
+    for user_id, mutes in user_mute_history.items():
+        for mute in mutes:
+            key = (int(mute['moderator_id']), int(user_id), mute['timestamp'])
+            if key not in seen:
+                rows.append((key[0], key[1], None, mute.get('reason'), mute.get('duration'), epoch_seconds(mute['timestamp'])))
+    rows.sort(key=lambda row: row[5])
+    return rows
+
+# User records
+# One slotted object per member instead of a nested dict. Times are epoch
+# seconds, and last_message is the member's newest CachedMessage - the same
+# object the message cache holds - rather than a copy of its content. On disk
+# records keep the per-user dict layout, so every storage backend reads and
+# writes them unchanged.
+
+class UserRecord:
+    """A member's online-time counters, session state and last activity"""
+    __slots__ = ('total_online_seconds', 'daily_seconds', 'weekly_seconds', 'monthly_seconds',
+                 'daily_period', 'weekly_period', 'monthly_period', 'online_start', 'offline_start',
+                 'last_online', 'last_edit', 'last_message')
+
+    def __init__(self):
+        self.total_online_seconds = 0
+        self.daily_seconds = 0
+        self.weekly_seconds = 0
+        self.monthly_seconds = 0
+        self.daily_period = 0
+        self.weekly_period = 0
+        self.monthly_period = 0
+        self.online_start = None
+        self.offline_start = None
+        self.last_online = None
+        self.last_edit = None
+        self.last_message = None
+
+    @classmethod
+    def new(cls, now: datetime):
+        record = cls()
+        for period in PERIODS:
+            setattr(record, f'{period}_period', period_index(period, now))
+        return record
+
+    @classmethod
+    def from_json(cls, value: dict):
+        record = cls()
+        record.total_online_seconds = value.get('total_online_seconds', 0)
+        periods = value.get('periods')
+        if periods is None:
+            # Rolling last_reset timestamps from before calendar periods
+            last_reset = value.get('last_reset') or {}
+            periods = {
+                period: period_index(period, datetime.fromisoformat(last_reset[period]) if last_reset.get(period) else datetime.now(pytz.utc))
+                for period in PERIODS
+            }
+        for period in PERIODS:
+            setattr(record, f'{period}_seconds', value.get(f'{period}_seconds', 0))
+            setattr(record, f'{period}_period', periods.get(period, 0))
+        record.online_start = epoch_seconds(value.get('online_start'))
+        record.offline_start = epoch_seconds(value.get('offline_start'))
+        record.last_online = epoch_seconds(value.get('last_online'))
+        record.last_edit = epoch_seconds(value.get('last_edit'))
+        last_message = value.get('last_message')
+        if last_message:
+            # Saved messages have no id, so they can't be matched to the cache again
+            record.last_message = CachedMessage(
+                None, None, None, last_message.get('content'), [], 0,
+                last_message.get('channel_id'), epoch_seconds(last_message.get('timestamp')), None, None
+            )
+        return record
+
+    def to_json(self) -> dict:
+        last_message = self.last_message
+        return {
+            'last_online': self.last_online,
+            'last_message': {
+                'content': last_message.content,
+                'timestamp': last_message.timestamp,
+                'channel_id': last_message.channel_id
+            } if last_message else None,
+            'last_edit': self.last_edit,
+            'total_online_seconds': self.total_online_seconds,
+            'online_start': self.online_start,
+            'daily_seconds': self.daily_seconds,
+            'weekly_seconds': self.weekly_seconds,
+            'monthly_seconds': self.monthly_seconds,
+            'periods': {period: getattr(self, f'{period}_period') for period in PERIODS},
+            'offline_start': self.offline_start
+        }
+
+def load_user_records(data: dict) -> list:
+    """Replace the loaded per-user dicts with records; returns the ids of
+    users whose periods had to be migrated (so they get written back)"""
+    users = data['users']
+    migrated = []
+    for user_id, value in users.items():
+        if isinstance(value, UserRecord):
+            continue
+        if 'periods' not in value:
+            migrated.append(user_id)
+        users[user_id] = UserRecord.from_json(value)
+    return migrated
+
+def benchmark_user_records(count: int = 100_000):
+    """Memory held by `count` users as loaded dicts vs records (python main.py --bench)"""
+    now = datetime.now(pytz.utc)
+    timestamp = int(now.timestamp())
+    messages = [
+        CachedMessage(i, i, f"user{i}", f"message number {i} from a benchmark user", [], 0, 1, timestamp, None, timestamp)
+        for i in range(count)
+    ]
+    sample = UserRecord.new(now)
+    sample.total_online_seconds = sample.daily_seconds = 3600
+    sample.online_start = sample.last_edit = timestamp
+    users_json = _dumps({
+        str(i): {**sample.to_json(), 'last_message': {'content': msg.content, 'timestamp': msg.timestamp, 'channel_id': 1}}
+        for i, msg in enumerate(messages)
+    })
+    
+    tracemalloc.start()
+    users = json.loads(users_json)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    tracemalloc.start()
+    records = {}
+    for user_id, value in json.loads(users_json).items():
+        # Measured as loaded: each record owns its last message until the cache
+        # sees a newer one, and the cache only keeps MESSAGE_CACHE_SIZE of them
+        records[user_id] = UserRecord.from_json(value)
+    record_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    lossless = all(records[user_id].to_json() == value for user_id, value in users.items())
+    print(f"👥 {count} users")
+    print(f"   dicts:   {dict_bytes / 2 ** 20:.1f} MB ({dict_bytes / count:.0f} B/user)")
+    print(f"   records: {record_bytes / 2 ** 20:.1f} MB ({record_bytes / count:.0f} B/user)")
+    print(f"   round trip to the JSON layout {'is loss-free' if lossless else 'LOST DATA'}")
+
 # Data storage
 DATA_FILE = 'bot_data.json'
+SQLITE_FILE = 'bot_data.db'
+JOURNAL_FILE = 'bot_data.journal'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+SAVE_DEBOUNCE_SECONDS = 5
+JOURNAL_FLUSH_SECONDS = 1
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
+def default_data() -> dict:
     return {
         'users': {},
         'mutes': {},
         'rmute_usage': {},
-        'cached_messages': [],
+        'cached_messages': MessageCache(),
+        'activity': ActivityHistory(),
         'rdm_users': [],
         'logs': [],
-        'mute_history': {},
-        'user_mute_history': {}
+        'cases': CaseStore()
     }
 
-def save_data():
-    with open(DATA_FILE, 'w') as f:
-        json.dump(bot_data, f, indent=4)
+def activity_dir(path: str) -> str:
+    return f"{os.path.splitext(path)[0]}_activity"
 
-bot_data = load_data()
+def load_activity_days(path: str) -> ActivityHistory:
+    history = ActivityHistory()
+    for name in os.listdir(path):
+        day, ext = os.path.splitext(name)
+        if ext != '.json' or not day.isdigit():
+            continue
+        with open(os.path.join(path, name), 'r') as f:
+            blocks = json.load(f)
+        for user_id, block in blocks.items():
+            history.set_block(ActivityHistory.block_key(user_id, day), DayBlock.from_json(block))
+    return history
 
-# Save data every 5 minutes to prevent data loss
-@tasks.loop(minutes=5)
-async def auto_save():
-    save_data()
-    print("✅ Auto-saved bot data")
+def load_data(path: str = DATA_FILE):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        data['cached_messages'] = MessageCache.from_json(data.get('cached_messages', []))
+        data['activity'] = ActivityHistory.from_json(data.get('activity', {}))
+        data['cases'] = CaseStore.from_json(data.get('cases', []))
+        if 'mute_history' in data or 'user_mute_history' in data:
+            legacy = legacy_mute_rows(data.pop('mute_history', {}), data.pop('user_mute_history', {}))
+            for row in legacy:
+                data['cases'].add(data['cases'].new_case(*row))
+    else:
+        data = default_data()
+    days_path = activity_dir(path)
+    if os.path.isdir(days_path):
+        # JSON storage keeps day blocks in per-day files beside the snapshot
+        data['activity'] = load_activity_days(days_path)
+    return data
 
-# Helper functions
-def has_mod_role(member):
-    """Check if member has moderator role"""
-    return any(role.id in MOD_ROLES for role in member.roles)
+def _new_cached_messages(data: dict, message_ids: set) -> list:
+    # Messages evicted before the flush simply drop out
+    cache = data['cached_messages']
+    new_messages = (cache.get(message_id) for message_id in sorted(message_ids or ()))
+    return [msg for msg in new_messages if msg is not None]
 
-def get_user_data(user_id: int):
-    user_id_str = str(user_id)
-    now = datetime.now(pytz.utc)
-    if user_id_str not in bot_data['users']:
-        bot_data['users'][user_id_str] = {
-            'last_online': None,
-            'last_message': None,
-            'last_edit': None,
-            'total_online_seconds': 0,
-            'online_start': None,
-            'daily_seconds': 0,
-            'weekly_seconds': 0,
-            'monthly_seconds': 0,
-            'last_reset': {
-                'daily': now.isoformat(),
-                'weekly': now.isoformat(),
-                'monthly': now.isoformat()
-            },
-            'offline_start': None
-        }
-    return bot_data['users'][user_id_str]
+def _encode_default(obj):
+    return obj.to_json()
 
-def format_duration(seconds: int) -> str:
-    days = seconds // 86400
-    hours = (seconds % 86400) // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
-    
-    parts = []
-    if days > 0:
-        parts.append(f"{days}d")
-    if hours > 0:
-        parts.append(f"{hours}h")
-    if minutes > 0:
-        parts.append(f"{minutes}m")
-    if secs > 0 or not parts:
-        parts.append(f"{secs}s")
-    
-    return " ".join(parts)
+def _dumps(obj) -> str:
+    # Compact separators keep json on its C encoder (indent forces the pure-python one)
+    return json.dumps(obj, separators=(',', ':'), default=_encode_default)
 
-def parse_duration(duration_str: str) -> int:
-    total_seconds = 0
-    current_num = ""
-    
-    for char in duration_str:
-        if char.isdigit():
-            current_num += char
-        elif char in ['d', 'h', 'm', 's']:
-            if current_num:
-                num = int(current_num)
-                if char == 'd':
-                    total_seconds += num * 86400
-                elif char == 'h':
-                    total_seconds += num * 3600
-                elif char == 'm':
-                    total_seconds += num * 60
-                elif char == 's':
-                    total_seconds += num
-                current_num = ""
-    
-    return total_seconds
+def snapshot_data(data: dict) -> dict:
+    """Shallow copy of the state for encoding in a worker thread.
 
-def format_time_in_timezones(dt: datetime) -> str:
-    lines = []
-    for name, tz in TIMEZONES.items():
-        local_time = dt.astimezone(tz)
-        lines.append(f"**{name}:** {local_time.strftime('%Y-%m-%d %I:%M:%S %p')}")
-    return "\n".join(lines)
+    Only the containers are copied, which is cheap enough for the event loop;
+    records are shared, and any change made while the copy is encoded marks
+    the state dirty again, so the next flush picks it up.
+    """
+    snapshot = {}
+    for section, value in data.items():
+        if isinstance(value, dict):
+            snapshot[section] = {key: dict(item) if isinstance(item, dict) else item for key, item in value.items()}
+        elif isinstance(value, ActivityHistory):
+            snapshot[section] = value.copy()
+        elif isinstance(value, (list, MessageCache, CaseStore)):
+            # The message ring buffer and the case store encode as plain lists
+            snapshot[section] = list(value)
+        else:
+            snapshot[section] = value
+    return snapshot
 
-def get_next_reset_times(user_data: dict) -> dict:
-    now = datetime.now(pytz.utc)
-    last_resets = user_data.get('last_reset', {})
-    
-    daily_last = datetime.fromisoformat(last_resets.get('daily', now.isoformat()))
-    weekly_last = datetime.fromisoformat(last_resets.get('weekly', now.isoformat()))
-    monthly_last = datetime.fromisoformat(last_resets.get('monthly', now.isoformat()))
-    
-    daily_next = daily_last + timedelta(days=1)
-    weekly_next = weekly_last + timedelta(weeks=1)
-    monthly_next = monthly_last + timedelta(days=30)
-    
-    return {
-        'daily': daily_next,
-        'weekly': weekly_next,
-        'monthly': monthly_next
-    }
+def _write_atomic(path: str, payload: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
-async def send_dm_safe(user: discord.User, embed: discord.Embed):
-    if str(user.id) in bot_data['rdm_users']:
-        return
-    try:
-        await user.send(embed=embed)
-    except:
-        pass
+class JsonStorage:
+    """Whole-file JSON storage, rewritten atomically on every flush.
 
-async def log_action(title: str, description: str = None, color: discord.Color = discord.Color.blue(), fields: list = None, dangerous: bool = False):
-    log_channel = bot.get_channel(MUTE_LOG_CHANNEL_ID)
-    if not log_channel:
-        return
-    
-    embed = discord.Embed(
-        title=title,
-        description=description,
-        color=color,
-        timestamp=datetime.now(pytz.utc)
-    )
-    
-    if fields:
-        for field in fields:
-            embed.add_field(name=field['name'], value=field['value'], inline=field.get('inline', False))
+    Activity history is kept out of the snapshot in one file per UTC day
+    ("<data file>_activity/<day ordinal>.json"), and a flush only rewrites
+    the days that changed.
+    """
+    history_in_memory = True
+    queries_on_disk = False
+    flush_delay = SAVE_DEBOUNCE_SECONDS
+    compacts = False
+
+    def __init__(self, data_path: str = DATA_FILE):
+        self.data_path = data_path
+        self.activity_dir = activity_dir(data_path)
+
+    def load(self) -> dict:
+        data = load_data(self.data_path)
+        if not os.path.isdir(self.activity_dir):
+            # Snapshots written before day files carried the history inline
+            os.makedirs(self.activity_dir)
+            history = data['activity']
+            self._write_days({day: history.day_blocks(day) for day in history.days()})
+        return data
+
+    def prepare(self, data: dict, changes: dict) -> tuple:
+        snapshot = snapshot_data({section: value for section, value in data.items() if section != 'activity'})
+        days = {int(key.split(':')[1]) for key in changes.get('activity', ())}
+        return snapshot, {day: data['activity'].day_blocks(day) for day in days}
+
+    def _write_days(self, days: dict) -> list:
+        payloads = []
+        for day, blocks in days.items():
+            path = os.path.join(self.activity_dir, f"{day}.json")
+            if blocks:
+                payloads.append(_dumps(blocks).encode())
+                _write_atomic(path, payloads[-1])
+            elif os.path.exists(path):
+                os.remove(path)
+        return payloads
+
+    def write(self, prepared: tuple) -> bytes:
+        snapshot, days = prepared
+        payloads = self._write_days(days)
+        payloads.append(_dumps(snapshot).encode())
+        _write_atomic(self.data_path, payloads[-1])
+        return b''.join(payloads)
+
+    def query_cases(self, data: dict, **filters):
+        return data['cases'].query(**filters)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mutes (
+    user_id INTEGER PRIMARY KEY,
+    moderator_id INTEGER,
+    reason TEXT,
+    duration INTEGER,
+    start_time INTEGER,
+    unmute_time INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_mutes_moderator_id ON mutes(moderator_id);
+CREATE INDEX IF NOT EXISTS idx_mutes_unmute_time ON mutes(unmute_time);
+CREATE TABLE IF NOT EXISTS mute_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    moderator_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    reason TEXT,
+    duration INTEGER,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mute_history_moderator ON mute_history(moderator_id);
+CREATE INDEX IF NOT EXISTS idx_mute_history_user ON mute_history(user_id);
+CREATE INDEX IF NOT EXISTS idx_mute_history_timestamp ON mute_history(timestamp);
+CREATE TABLE IF NOT EXISTS case_tokens (
+    token TEXT NOT NULL,
+    case_id INTEGER NOT NULL,
+    PRIMARY KEY (token, case_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rmute_usage (moderator_id INTEGER PRIMARY KEY, count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS rdm_users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS cached_messages (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER,
+    author_id INTEGER,
+    timestamp INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cached_messages_author_id ON cached_messages(author_id);
+CREATE INDEX IF NOT EXISTS idx_cached_messages_channel_id ON cached_messages(channel_id);
+CREATE TABLE IF NOT EXISTS activity (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    minutes INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+CREATE INDEX IF NOT EXISTS idx_activity_day ON activity(day);
+"""
+
+UPSERT_USER = (
+    "INSERT INTO users (user_id, data) VALUES (?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data"
+)
+UPSERT_MUTE = (
+    "INSERT INTO mutes (user_id, moderator_id, reason, duration, start_time, unmute_time) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET moderator_id = excluded.moderator_id, reason = excluded.reason, "
+    "duration = excluded.duration, start_time = excluded.start_time, unmute_time = excluded.unmute_time"
+)
+UPSERT_RMUTE_USAGE = (
+    "INSERT INTO rmute_usage (moderator_id, count) VALUES (?, ?) "
+    "ON CONFLICT(moderator_id) DO UPDATE SET count = excluded.count"
+)
+INSERT_CASE = (
+    "INSERT OR IGNORE INTO mute_history (id, moderator_id, user_id, user_name, reason, duration, timestamp) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+INSERT_CASE_TOKEN = "INSERT OR IGNORE INTO case_tokens (token, case_id) VALUES (?, ?)"
+UPSERT_ACTIVITY = (
+    "INSERT OR REPLACE INTO activity (user_id, day, minutes, data) VALUES (?, ?, ?, ?)"
+)
+INSERT_CACHED_MESSAGE = (
+    "INSERT OR REPLACE INTO cached_messages (id, channel_id, author_id, timestamp, data) VALUES (?, ?, ?, ?, ?)"
+)
+
+class SQLiteStorage:
+    """SQLite (WAL) storage: flushes are row-level upserts of the keys marked dirty.
+
+    Mute history only lives on disk; users, mutes, usage counters, DM opt-outs
+    and the message cache are still mirrored in memory for the hot paths.
+    """
+    history_in_memory = False
+    queries_on_disk = True
+    flush_delay = SAVE_DEBOUNCE_SECONDS
+    compacts = False
+
+    def __init__(self, path: str = SQLITE_FILE, json_path: str = DATA_FILE):
+        self.path = path
+        self.json_path = json_path
+        self.writer = None
+        self.reader = None
+
+    def _connect(self):
+        self.writer = sqlite3.connect(self.path, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.executescript(SQLITE_SCHEMA)
+        if self.writer.execute("SELECT 1 FROM meta WHERE key = 'case_tokens'").fetchone() is None:
+            # Index reasons of cases written before the token table existed
+            rows = self.writer.execute("SELECT id, reason FROM mute_history").fetchall()
+            for case_id, reason in rows:
+                self.writer.executemany(INSERT_CASE_TOKEN, [(token, case_id) for token in reason_tokens(reason)])
+            self.writer.execute("INSERT INTO meta (key, value) VALUES ('case_tokens', '1')")
+        self.writer.commit()
+        self.reader = sqlite3.connect(self.path, check_same_thread=False)
+        self.reader.row_factory = sqlite3.Row
+
+    def load(self) -> dict:
+        self._connect()
+        migrated = self.writer.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+        if migrated is None and os.path.exists(self.json_path):
+            self.migrate_json(load_data(self.json_path))
+            os.replace(self.json_path, f"{self.json_path}.migrated")
+            print(f"✅ Migrated {self.json_path} into {self.path}")
+
+        data = default_data()
+        for user_id, user_json in self.reader.execute("SELECT user_id, data FROM users"):
+            data['users'][str(user_id)] = json.loads(user_json)
+        for row in self.reader.execute("SELECT * FROM mutes"):
+            data['mutes'][str(row['user_id'])] = {
+                'moderator_id': row['moderator_id'],
+                'reason': row['reason'],
+                'duration': row['duration'],
+                'start_time': row['start_time'],
+                'unmute_time': row['unmute_time']
+            }
+        for moderator_id, count in self.reader.execute("SELECT moderator_id, count FROM rmute_usage"):
+            data['rmute_usage'][str(moderator_id)] = count
+        data['rdm_users'] = [str(row[0]) for row in self.reader.execute("SELECT user_id FROM rdm_users")]
+        rows = self.reader.execute(
+            "SELECT data FROM cached_messages ORDER BY id DESC LIMIT ?", (MESSAGE_CACHE_SIZE,)
+        ).fetchall()
+        data['cached_messages'] = MessageCache.from_json([json.loads(row[0]) for row in reversed(rows)])
+        for user_id, day, block_json in self.reader.execute("SELECT user_id, day, data FROM activity"):
+            data['activity'].set_block(f"{user_id}:{day}", DayBlock.from_json(json.loads(block_json)))
+        # Cases stay on disk; the in-memory store only hands out the next case id
+        last_case_id = self.reader.execute("SELECT MAX(id) FROM mute_history").fetchone()[0]
+        data['cases'].next_id = (last_case_id or 0) + 1
+        return data
+
+    def migrate_json(self, data: dict):
+        """One-shot import of an existing bot_data.json"""
+        with self.writer:
+            load_user_records(data)
+            for user_id, record in data['users'].items():
+                self.writer.execute(UPSERT_USER, self._user_row(user_id, record))
+            for user_id, mute in data.get('mutes', {}).items():
+                self.writer.execute(UPSERT_MUTE, self._mute_row(user_id, mute))
+            for moderator_id, count in data.get('rmute_usage', {}).items():
+                self.writer.execute(UPSERT_RMUTE_USAGE, (int(moderator_id), count))
+            for user_id in data.get('rdm_users', []):
+                self.writer.execute("INSERT OR IGNORE INTO rdm_users (user_id) VALUES (?)", (int(user_id),))
+            for msg in data['cached_messages']:
+                self.writer.execute(INSERT_CACHED_MESSAGE, self._message_row(msg))
+            for user_id, days in data['activity'].to_json().items():
+                for day, block in days.items():
+                    self.writer.execute(UPSERT_ACTIVITY, (int(user_id), int(day), block[2], _dumps(block)))
+
+            for case in data['cases']:
+                self._insert_case(self.writer, case.to_json())
+
+            self.writer.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (self.json_path,))
+
+    @staticmethod
+    def _user_row(user_id, record: UserRecord) -> tuple:
+        return (int(user_id), _dumps(record))
+
+    @staticmethod
+    def _mute_row(user_id, mute: dict) -> tuple:
+        return (
+            int(user_id), mute.get('moderator_id'), mute.get('reason'), mute.get('duration'),
+            epoch_seconds(mute.get('start_time')), epoch_seconds(mute.get('unmute_time'))
+        )
+
+    @staticmethod
+    def _insert_case(conn, row):
+        conn.execute(INSERT_CASE, tuple(row))
+        conn.executemany(INSERT_CASE_TOKEN, [(token, row[0]) for token in reason_tokens(row[4])])
+
+    @staticmethod
+    def _message_row(msg: CachedMessage) -> tuple:
+        return (msg.id, msg.channel_id, msg.author_id, msg.timestamp, _dumps(msg))
+
+    def prepare(self, data: dict, changes: dict) -> list:
+        # Runs on the event loop so rows are a consistent snapshot; write() only does I/O
+        ops = []
+        for key in changes.get('activity', ()):
+            user_id, day = map(int, key.split(':'))
+            block = data['activity'].get_block(key)
+            if block is None:
+                ops.append(("DELETE FROM activity WHERE user_id = ? AND day = ?", (user_id, day)))
+            else:
+                ops.append((UPSERT_ACTIVITY, (user_id, day, block.minutes, _dumps(block))))
+
+        for user_id in changes.get('users', ()):
+            record = data['users'].get(user_id)
+            if record is None:
+                ops.append(("DELETE FROM users WHERE user_id = ?", (int(user_id),)))
+            else:
+                ops.append((UPSERT_USER, self._user_row(user_id, record)))
+
+        for user_id in changes.get('mutes', ()):
+            mute = data['mutes'].get(user_id)
+            if mute is None:
+                ops.append(("DELETE FROM mutes WHERE user_id = ?", (int(user_id),)))
+            else:
+                ops.append((UPSERT_MUTE, self._mute_row(user_id, mute)))
+
+        for moderator_id in changes.get('rmute_usage', ()):
+            ops.append((UPSERT_RMUTE_USAGE, (int(moderator_id), data['rmute_usage'].get(moderator_id, 0))))
+
+        for user_id in changes.get('rdm_users', ()):
+            if user_id in data['rdm_users']:
+                ops.append(("INSERT OR IGNORE INTO rdm_users (user_id) VALUES (?)", (int(user_id),)))
+            else:
+                ops.append(("DELETE FROM rdm_users WHERE user_id = ?", (int(user_id),)))
+
+        for row in changes.get('cases', ()):
+            ops.append((INSERT_CASE, row))
+            for token in reason_tokens(row[4]):
+                ops.append((INSERT_CASE_TOKEN, (token, row[0])))
+
+        new_messages = _new_cached_messages(data, changes.get('cached_messages'))
+        for msg in new_messages:
+            ops.append((INSERT_CACHED_MESSAGE, self._message_row(msg)))
+        if new_messages:
+            ops.append(("DELETE FROM cached_messages WHERE id < ?", (data['cached_messages'].oldest().id,)))
+        return ops
+
+    def write(self, ops: list) -> list:
+        with self.writer:
+            for sql, params in ops:
+                self.writer.execute(sql, params)
+        return ops
+
+    def query_cases(self, data: dict, moderator_id: int = None, user_id: int = None, tokens: tuple = (),
+                    since: datetime = None, until: datetime = None, min_duration: int = None,
+                    max_duration: int = None, offset: int = 0, limit: int = 10):
+        clauses = []
+        params = []
+        for clause, value in (
+            ("moderator_id = ?", moderator_id),
+            ("user_id = ?", user_id),
+            ("timestamp >= ?", int(since.timestamp()) if since else None),
+            ("timestamp <= ?", int(until.timestamp()) if until else None),
+            ("COALESCE(duration, 0) >= ?", min_duration),
+            ("COALESCE(duration, 0) <= ?", max_duration)
+        ):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        for token in tokens:
+            clauses.append("id IN (SELECT case_id FROM case_tokens WHERE token = ?)")
+            params.append(token)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        
+        total = self.reader.execute(f"SELECT COUNT(*) FROM mute_history {where}", params).fetchone()[0]
+        rows = self.reader.execute(
+            f"SELECT id, moderator_id, user_id, user_name, reason, duration, timestamp FROM mute_history {where} "
+            "ORDER BY id DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset)
+        )
+        return total, [Case.from_json(row) for row in rows]
+
+class JournalStorage(JsonStorage):
+    """Append-only journal on top of periodic JSON snapshots.
+
+    Each flush appends one compact record per changed key, so a write costs
+    what changed rather than the whole state. Startup loads the latest
+    snapshot and replays the journal records newer than it; compaction
+    writes a fresh snapshot and truncates the journal.
+    """
+    flush_delay = JOURNAL_FLUSH_SECONDS
+    compacts = True
+
+    def __init__(self, path: str = JOURNAL_FILE, data_path: str = DATA_FILE):
+        super().__init__(data_path)
+        self.path = path
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.journal = None
+
+    def load(self) -> dict:
+        data = load_data(self.data_path)
+        snapshot_seq = data.pop('_journal_seq', 0)
+        self.seq = self.snapshot_seq = snapshot_seq
+        replayed = 0
+        good_offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        seq, op, section, key, value = json.loads(line)
+                    except ValueError:
+                        # Torn write at the tail from a crash mid-append
+                        break
+                    good_offset += len(line)
+                    if seq <= snapshot_seq:
+                        continue
+                    self.apply(data, op, section, key, value)
+                    self.seq = seq
+                    replayed += 1
+            if good_offset < os.path.getsize(self.path):
+                # Cut the torn tail so new records start on a clean line
+                print(f"⚠️ Dropped a torn journal tail after byte {good_offset}")
+                os.truncate(self.path, good_offset)
+        if replayed:
+            print(f"✅ Replayed {replayed} journal records")
+        self.journal = open(self.path, 'ab')
+        return data
+
+    @staticmethod
+    def apply(data: dict, op: str, section: str, key, value):
+        if section == 'cached_messages':
+            data['cached_messages'].append(CachedMessage.from_json(value))
+        elif section == 'cases':
+            data['cases'].add(Case.from_json(value))
+        elif section == 'activity':
+            data['activity'].set_block(key, DayBlock.from_json(value) if op == 's' else None)
+        elif section == 'rdm_users':
+            if op == 's' and key not in data['rdm_users']:
+                data['rdm_users'].append(key)
+            elif op == 'd' and key in data['rdm_users']:
+                data['rdm_users'].remove(key)
+        elif op == 's':
+            data[section][key] = value
+        else:
+            data[section].pop(key, None)
+
+    def _record(self, op: str, section: str, key=None, value=None) -> str:
+        self.seq += 1
+        return _dumps([self.seq, op, section, key, value])
+
+    def prepare(self, data: dict, changes: dict) -> bytes:
+        records = []
+        for section in ('users', 'mutes', 'rmute_usage'):
+            for key in changes.get(section, ()):
+                value = data[section].get(key)
+                if value is None:
+                    records.append(self._record('d', section, key))
+                else:
+                    records.append(self._record('s', section, key, value))
+        for key in changes.get('activity', ()):
+            block = data['activity'].get_block(key)
+            if block is None:
+                records.append(self._record('d', 'activity', key))
+            else:
+                records.append(self._record('s', 'activity', key, block))
+        for user_id in changes.get('rdm_users', ()):
+            records.append(self._record('s' if user_id in data['rdm_users'] else 'd', 'rdm_users', user_id))
+        for row in sorted(changes.get('cases', ())):
+            records.append(self._record('a', 'cases', value=row))
+        for msg in _new_cached_messages(data, changes.get('cached_messages')):
+            records.append(self._record('a', 'cached_messages', value=msg))
+        if not records:
+            return b''
+        return ('\n'.join(records) + '\n').encode()
+
+    def write(self, payload: bytes) -> bytes:
+        if not payload:
+            return payload
+        self.journal.write(payload)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        return payload
+
+    def prepare_snapshot(self, data: dict) -> dict:
+        self.snapshot_seq = self.seq
+        return {**snapshot_data(data), '_journal_seq': self.seq}
+
+    def write_snapshot(self, snapshot: dict) -> bytes:
+        payload = _dumps(snapshot).encode()
+        _write_atomic(self.data_path, payload)
+        # Records up to the snapshot's sequence are now redundant, and day files
+        # left by JSON storage are superseded by the history in the snapshot
+        self.journal.truncate(0)
+        if os.path.isdir(self.activity_dir):
+            shutil.rmtree(self.activity_dir)
+        return payload
+
+def create_storage(data_dir: str = ''):
+    data_path = os.path.join(data_dir, DATA_FILE)
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteStorage(os.path.join(data_dir, SQLITE_FILE), data_path)
+    if STORAGE_BACKEND == 'journal':
+        return JournalStorage(os.path.join(data_dir, JOURNAL_FILE), data_path)
+    return JsonStorage(data_path)
+
+def open_guild_data(config: GuildConfig):
+    """Load a guild's storage (blocking; run from a worker thread)"""
+    if config.data_dir:
+        os.makedirs(config.data_dir, exist_ok=True)
+    storage = create_storage(config.data_dir)
+    data = storage.load()
+    migrated = load_user_records(data)
+    for mute in data['mutes'].values():
+        mute['start_time'] = epoch_seconds(mute.get('start_time'))
+        mute['unmute_time'] = epoch_seconds(mute.get('unmute_time'))
+    return storage, data, migrated
+
+# Guild state: each configured guild has its own data, storage and background
+# services. Handlers mark what changed and a debounced flush writes it out from
+# a worker thread, so bursts of changes cost a single write, and a save only
+# ever touches the guild whose state changed.
+class GuildState:
+    """Data, storage and per-guild services (log queue, activity tracking,
+    leaderboards, unmutes) for one guild, with its own write-behind queue"""
+
+    def __init__(self, config: GuildConfig, storage, data: dict, migrated: list = ()):
+        self.config = config
+        self.guild_id = config.guild_id
+        self.storage = storage
+        self.data = data
+        self._dirty = False
+        self._changes = {}
+        self._save_task = None
+        self._save_lock = asyncio.Lock()
+        self.log_queue = LogQueue(config)
+        self.leaderboards = LeaderboardIndex(self)
+        self.activity = ActivityTracker(self)
+        self.unmutes = UnmuteScheduler(self)
+        for user_id in migrated:
+            self.mark_dirty('users', user_id)
+
+    @property
+    def guild(self) -> Optional[discord.Guild]:
+        return bot.get_guild(self.guild_id)
+
+    async def start(self, guild: discord.Guild):
+        """Start the guild's background services once its members are cached"""
+        if not guild.chunked:
+            await guild.chunk()
+        self.activity.start(guild)
+        self.leaderboards.rebuild(guild, self.activity.tracked)
+        self.unmutes.start()
+
+    def mark_dirty(self, section: str, key=None):
+        self._dirty = True
+        self._changes.setdefault(section, set()).add(key)
+        if self._save_task is None or self._save_task.done():
+            try:
+                self._save_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+            except RuntimeError:
+                pass
+
+    def pending_changes(self) -> int:
+        return sum(len(keys) for keys in self._changes.values())
+
+    def _take_changes(self) -> dict:
+        changes, self._changes = self._changes, {}
+        self._dirty = False
+        return changes
+
+    def _restore_changes(self, changes: dict):
+        self._dirty = True
+        for section, keys in changes.items():
+            self._changes.setdefault(section, set()).update(keys)
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.storage.flush_delay)
+        self._save_task = None
+        await self.flush()
+
+    async def flush(self) -> bool:
+        async with self._save_lock:
+            if not self._dirty:
+                return False
+            changes = self._take_changes()
+            start = time.perf_counter()
+            try:
+                # Only the cheap snapshot is taken on the loop; encoding happens in write()
+                snapshot = self.storage.prepare(self.data, changes)
+                payload = await asyncio.to_thread(self.storage.write, snapshot)
+            except Exception as e:
+                self._restore_changes(changes)
+                print(f"❌ Failed to save bot data for guild {self.guild_id}: {e}")
+                return False
+            record_save('flush', start, payload)
+            return True
+
+    async def compact(self) -> bool:
+        """Fold the journal into a fresh snapshot (journal storage only)"""
+        storage = self.storage
+        if not storage.compacts or (not self._dirty and storage.seq == storage.snapshot_seq):
+            return False
+        async with self._save_lock:
+            # The snapshot covers every in-memory change, including ones not journaled yet
+            changes = self._take_changes()
+            start = time.perf_counter()
+            try:
+                snapshot = storage.prepare_snapshot(self.data)
+                payload = await asyncio.to_thread(storage.write_snapshot, snapshot)
+            except Exception as e:
+                self._restore_changes(changes)
+                print(f"❌ Failed to write snapshot for guild {self.guild_id}: {e}")
+                return False
+            record_save('snapshot', start, payload)
+            return True
+
+    def save(self):
+        """Write pending changes immediately (blocking, used on shutdown)"""
+        self.storage.write(self.storage.prepare(self.data, self._take_changes()))
+
+    async def sync(self):
+        """Make sure queries that read from disk see the latest in-memory state"""
+        if self.storage.queries_on_disk:
+            await self.flush()
+
+    def user_data(self, user_id: int) -> UserRecord:
+        user_id_str = str(user_id)
+        users = self.data['users']
+        if user_id_str not in users:
+            users[user_id_str] = UserRecord.new(datetime.now(pytz.utc))
+            self.mark_dirty('users', user_id_str)
+        return users[user_id_str]
+
+    def add_case(self, moderator_id: int, user_id: int, user_name: str, reason: str, duration: int, timestamp: int) -> Case:
+        case = self.data['cases'].new_case(moderator_id, user_id, user_name, reason, duration, timestamp)
+        if self.storage.history_in_memory:
+            self.data['cases'].add(case)
+        self.mark_dirty('cases', tuple(case.to_json()))
+        return case
+
+    def record_activity_history(self, user_id: int, start: float, end: float):
+        for key in self.data['activity'].record(user_id, start, end):
+            self.mark_dirty('activity', key)
+
+    def apply_retention(self):
+        for key in self.data['activity'].apply_retention(day_ordinal(time.time())):
+            self.mark_dirty('activity', key)
+
+class GuildRegistry:
+    """Guild states, loaded on first use.
+
+    Loading runs in a worker thread and concurrent first uses share it, so
+    a large guild loading never blocks events for the others.
+    """
+
+    def __init__(self, configs: dict):
+        self.configs = configs
+        self._states = {}
+        self._loading = {}
+
+    def loaded(self) -> list:
+        return list(self._states.values())
+
+    def peek(self, guild_id: int) -> Optional[GuildState]:
+        return self._states.get(guild_id)
+
+    async def get(self, guild: Optional[discord.Guild]) -> Optional[GuildState]:
+        config = guild_config(guild)
+        if config is None:
+            return None
+        state = self._states.get(config.guild_id)
+        if state is not None:
+            return state
+        
+        future = self._loading.get(config.guild_id)
+        if future is None:
+            future = self._loading[config.guild_id] = asyncio.ensure_future(self._load(config))
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._loading.pop(config.guild_id, None)
+
+    async def _load(self, config: GuildConfig) -> GuildState:
+        storage, data, migrated = await asyncio.to_thread(open_guild_data, config)
+        state = self._states[config.guild_id] = GuildState(config, storage, data, migrated)
+        print(f"📂 Loaded data for guild {config.guild_id} ({len(data['users'])} users)")
+        return state
+
+guild_states = GuildRegistry(guild_configs)
+
+# Flush anything still pending every 5 minutes as a safety net; in journal
+# mode this is also when the journal gets compacted into a snapshot
+@tasks.loop(minutes=5)
+@instrument('task:auto_save')
+async def auto_save():
+    for state in guild_states.loaded():
+        if state.storage.compacts:
+            if await state.compact():
+                print(f"✅ Compacted bot data journal for guild {state.guild_id}")
+        elif await state.flush():
+            print(f"✅ Auto-saved bot data for guild {state.guild_id}")
+
+@tasks.loop(hours=1)
+@instrument('task:activity_retention')
+async def activity_retention():
+    for state in guild_states.loaded():
+        state.apply_retention()
+
+def save_data():
+    """Write every loaded guild's pending changes (blocking, used on shutdown)"""
+    for state in guild_states.loaded():
+        state.save()
+
+# Helper functions
+def has_mod_role(member):
+    """Check if member has a moderator role in their guild"""
+    config = guild_config(member.guild)
+    return config is not None and any(role.id in config.mod_roles for role in member.roles)
+
+def format_duration(seconds: int) -> str:
+    days = seconds // 86400
+    hours = (seconds % 86400) // 3600
+    minutes = (seconds % 3600) // 60
+    secs = seconds % 60
+    
+    parts = []
+    if days > 0:
+        parts.append(f"{days}d")
+    if hours > 0:
+        parts.append(f"{hours}h")
+    if minutes > 0:
+        parts.append(f"{minutes}m")
+    if secs > 0 or not parts:
+        parts.append(f"{secs}s")
+    
+    return " ".join(parts)
+
+def parse_duration(duration_str: str) -> int:
+    total_seconds = 0
+    current_num = ""
     
-    await log_channel.send(embed=embed)
+    for char in duration_str:
+        if char.isdigit():
+            current_num += char
+        elif char in ['d', 'h', 'm', 's']:
+            if current_num:
+                num = int(current_num)
+                if char == 'd':
+                    total_seconds += num * 86400
+                elif char == 'h':
+                    total_seconds += num * 3600
+                elif char == 'm':
+                    total_seconds += num * 60
+                elif char == 's':
+                    total_seconds += num
+                current_num = ""
     
-    if dangerous:
-        for user_id in DANGEROUS_LOG_USERS:
+    return total_seconds
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+@functools.lru_cache(maxsize=256)
+def timezone_offsets(hour: int) -> tuple:
+    """(name, UTC offset in seconds) of each display timezone during one UTC
+    hour; their DST changes fall on the hour, so the whole hour shares them"""
+    utc_time = datetime.fromtimestamp(hour * 3600, pytz.utc)
+    return tuple((name, int(utc_time.astimezone(tz).utcoffset().total_seconds())) for name, tz in TIMEZONES.items())
+
+def format_time_in_timezones(value) -> str:
+    """Local time in each display timezone of an epoch time (or aware datetime)"""
+    timestamp = int(value.timestamp()) if isinstance(value, datetime) else int(value)
+    lines = []
+    for name, offset in timezone_offsets(timestamp // 3600):
+        local_time = UNIX_EPOCH + timedelta(seconds=timestamp + offset)
+        lines.append(f"**{name}:** {local_time.strftime('%Y-%m-%d %I:%M:%S %p')}")
+    return "\n".join(lines)
+
+# Period counters: daily/weekly/monthly seconds belong to the calendar period
+# recorded in the record's *_period fields (UTC day, ISO week, calendar month) and are
+# only rolled over when that user's stats are written, so idle users cost nothing.
+PERIODS = ('daily', 'weekly', 'monthly')
+
+def period_index(period: str, dt: datetime) -> int:
+    if period == 'daily':
+        return dt.toordinal()
+    if period == 'weekly':
+        # Ordinal day 1 (0001-01-01) is a Monday, so this counts ISO weeks
+        return (dt.toordinal() - 1) // 7
+    return dt.year * 12 + dt.month - 1
+
+def period_start(period: str, index: int) -> datetime:
+    if period == 'daily':
+        start = datetime.fromordinal(index)
+    elif period == 'weekly':
+        start = datetime.fromordinal(index * 7 + 1)
+    else:
+        start = datetime(index // 12, index % 12 + 1, 1)
+    return start.replace(tzinfo=pytz.utc)
+
+def get_period_seconds(record: UserRecord, period: str, now: datetime = None) -> int:
+    now = now or datetime.now(pytz.utc)
+    if getattr(record, f'{period}_period') != period_index(period, now):
+        return 0
+    return getattr(record, f'{period}_seconds')
+
+def roll_periods(record: UserRecord, now: datetime) -> bool:
+    rolled = False
+    for period in PERIODS:
+        index = period_index(period, now)
+        if getattr(record, f'{period}_period') != index:
+            setattr(record, f'{period}_period', index)
+            setattr(record, f'{period}_seconds', 0)
+            rolled = True
+    return rolled
+
+def get_next_reset_times(record: UserRecord) -> dict:
+    now = datetime.now(pytz.utc)
+    return {period: period_start(period, period_index(period, now) + 1) for period in PERIODS}
+
+async def send_dm_safe(state, user: discord.User, embed: discord.Embed):
+    if str(user.id) in state.data['rdm_users']:
+        return
+    # One route label for all DMs; per-user labels would grow without bound
+    try:
+        await user.send(embed=embed)
+    except discord.HTTPException as e:
+        metrics.inc('bot_broadcast_sends_total', "Broadcast sends per target and outcome", route='dm', outcome='error')
+        print(f"⚠️ DM to {user.id} failed: {type(e).__name__}: {e}")
+    else:
+        metrics.inc('bot_broadcast_sends_total', "Broadcast sends per target and outcome", route='dm', outcome='ok')
+
+async def log_action(state, title: str, description: str = None, color: discord.Color = discord.Color.blue(), fields: list = None, dangerous: bool = False):
+    log_channel = bot.get_channel(state.config.mute_log_channel_id)
+    if not log_channel:
+        return
+    
+    embed = discord.Embed(
+        title=title,
+        description=description,
+        color=color,
+        timestamp=datetime.now(pytz.utc)
+    )
+    
+    if fields:
+        for field in fields:
+            embed.add_field(name=field['name'], value=field['value'], inline=field.get('inline', False))
+    
+    state.log_queue.put(embed, dangerous)
+
+# User resolution
+USER_CACHE_TTL = 3600
+USER_CACHE_SIZE = 1000
+
+class UserResolver:
+    """Resolves user ids with as few REST calls as possible.
+
+    Lookups try the client's user cache and guild member caches first, then
+    a TTL + LRU cache of users (and DM channels) fetched earlier. Concurrent
+    lookups of the same id share one fetch_user() call.
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users = OrderedDict()
+        self._dm_channels = OrderedDict()
+        self._inflight = {}
+        self.fetches = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def _get(self, cache: OrderedDict, key: int):
+        item = cache.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+    def _put(self, cache: OrderedDict, key: int, value):
+        cache[key] = (time.monotonic() + self.ttl, value)
+        cache.move_to_end(key)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def get_cached(self, user_id: int, guild: discord.Guild = None):
+        user = bot.get_user(user_id)
+        if user is None and guild is not None:
+            user = guild.get_member(user_id)
+        if user is None:
+            user = self._get(self._users, user_id)
+        return user
+
+    async def fetch(self, user_id: int, guild: discord.Guild = None):
+        user = self.get_cached(user_id, guild)
+        if user is not None:
+            return user
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id))
+            self._inflight[user_id] = task
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id: int):
+        try:
+            self.fetches += 1
+            user = await bot.fetch_user(user_id)
+            self._put(self._users, user_id, user)
+            return user
+        finally:
+            self._inflight.pop(user_id, None)
+
+    async def fetch_many(self, user_ids, guild: discord.Guild = None) -> dict:
+        """Resolve several ids concurrently; ids that fail map to None"""
+        unique_ids = list(dict.fromkeys(user_ids))
+        results = await asyncio.gather(*(self.fetch(user_id, guild) for user_id in unique_ids), return_exceptions=True)
+        return {
+            user_id: None if isinstance(result, BaseException) else result
+            for user_id, result in zip(unique_ids, results)
+        }
+
+    async def dm_channel(self, user_id: int) -> discord.DMChannel:
+        channel = self._get(self._dm_channels, user_id)
+        if channel is None:
+            user = await self.fetch(user_id)
+            channel = user.dm_channel or await user.create_dm()
+            self._put(self._dm_channels, user_id, channel)
+        return channel
+
+user_resolver = UserResolver()
+
+# Broadcast dispatch
+BROADCAST_CONCURRENCY = 8
+
+class BroadcastDispatcher:
+    """Sends the same message to several destinations concurrently.
+
+    A semaphore bounds how many sends are in flight overall, and a lock per
+    route (a channel, or a DM with one user) keeps each destination to one
+    request at a time, matching how Discord buckets message sends. Every
+    send's latency and outcome is exported per target (route) to /metrics.
+    """
+
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._routes = {}
+
+    @staticmethod
+    def route_for(target) -> str:
+        if isinstance(target, int):
+            return f"dm:{target}"
+        return f"channel:{target.id}"
+
+    async def send(self, targets, file_factory=None, **kwargs) -> list:
+        """Send to every target; ints are user ids to DM. Returns (route, error) pairs"""
+        targets = [target for target in targets if target is not None]
+        return await asyncio.gather(*(self._send_one(target, file_factory, kwargs) for target in targets))
+
+    async def _send_one(self, target, file_factory, kwargs: dict):
+        route = self.route_for(target)
+        lock = self._routes.setdefault(route, asyncio.Lock())
+        error = None
+        async with self._semaphore, lock:
+            start = time.perf_counter()
             try:
-                user = await bot.fetch_user(user_id)
-                await user.send(embed=embed)
-            except:
-                pass
+                channel = await user_resolver.dm_channel(target) if isinstance(target, int) else target
+                if file_factory:
+                    kwargs = {**kwargs, 'file': file_factory()}
+                await channel.send(**kwargs)
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - start
+        
+        metrics.observe('bot_broadcast_send_seconds', "Broadcast send latency per target", elapsed, route=route)
+        metrics.inc('bot_broadcast_sends_total', "Broadcast sends per target and outcome",
+                    route=route, outcome='error' if error else 'ok')
+        if error:
+            print(f"⚠️ Send to {route} failed: {type(error).__name__}: {error}")
+        return route, error
+
+broadcaster = BroadcastDispatcher()
+
+# Log queue
+LOG_QUEUE_SIZE = 500
+LOG_BATCH_WINDOW = 1.0
+LOG_FOLD_THRESHOLD = 5
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+
+class LogQueue:
+    """Outbound queue for the mute log channel with a single consumer.
+
+    Handlers enqueue an embed and return straight away. The consumer waits
+    LOG_BATCH_WINDOW after the first queued embed, folds event types that
+    repeated LOG_FOLD_THRESHOLD or more times into one summary embed, and
+    sends the rest packed up to 10 embeds (and 6000 characters) per message.
+    The queue is bounded: when full, routine embeds are dropped (or evicted
+    to make room for dangerous ones) and the drops are counted and reported.
+    Each guild has its own queue feeding its own log channel; the counts
+    across all queues are exported to /metrics.
+    """
+
+    def __init__(self, config: GuildConfig, maxsize: int = LOG_QUEUE_SIZE):
+        self.config = config
+        self.maxsize = maxsize
+        self._queue = deque()
+        self._ready = asyncio.Event()
+        self._task = None
+        self._unreported_drops = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, embed: discord.Embed, dangerous: bool = False):
+        if len(self._queue) >= self.maxsize:
+            metrics.inc('bot_log_embeds_total', "Log embeds enqueued, dropped or folded", event='dropped')
+            self._unreported_drops += 1
+            if not dangerous:
+                return
+            for i, (_, queued_dangerous) in enumerate(self._queue):
+                if not queued_dangerous:
+                    del self._queue[i]
+                    break
+            else:
+                return
+        
+        self._queue.append((embed, dangerous))
+        metrics.inc('bot_log_embeds_total', "Log embeds enqueued, dropped or folded", event='enqueued')
+        self._ready.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            await asyncio.sleep(LOG_BATCH_WINDOW)
+            batch = list(self._queue)
+            self._queue.clear()
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                print(f"❌ Failed to flush log queue for guild {self.config.guild_id}: {e}")
+
+    async def _flush(self, batch: list):
+        embeds, dangerous_embeds = self._fold(batch)
+        if self._unreported_drops:
+            embeds.append(discord.Embed(
+                title="⚠️ Log Events Dropped",
+                description=f"{self._unreported_drops} log event(s) were dropped because the log queue was full",
+                color=discord.Color.dark_orange(),
+                timestamp=datetime.now(pytz.utc)
+            ))
+            self._unreported_drops = 0
+        
+        log_channel = bot.get_channel(self.config.mute_log_channel_id)
+        if not log_channel:
+            return
+        
+        for chunk in self._pack(embeds):
+            await broadcaster.send([log_channel], embeds=chunk)
+            metrics.inc('bot_log_messages_total', "Messages sent to log channels")
+            metrics.inc('bot_log_embeds_sent_total', "Embeds sent to log channels", len(chunk))
+        for chunk in self._pack(dangerous_embeds):
+            await broadcaster.send(self.config.dangerous_log_users, embeds=chunk)
+
+    def _fold(self, batch: list):
+        counts = {}
+        for embed, dangerous in batch:
+            if not dangerous:
+                counts[embed.title] = counts.get(embed.title, 0) + 1
+        folded = {title for title, count in counts.items() if count >= LOG_FOLD_THRESHOLD}
+        
+        embeds = []
+        dangerous_embeds = []
+        emitted = set()
+        for embed, dangerous in batch:
+            if dangerous:
+                embeds.append(embed)
+                dangerous_embeds.append(embed)
+            elif embed.title not in folded:
+                embeds.append(embed)
+            elif embed.title not in emitted:
+                emitted.add(embed.title)
+                group = [e for e, d in batch if not d and e.title == embed.title]
+                embeds.append(self._summary(embed.title, group))
+                metrics.inc('bot_log_embeds_total', "Log embeds enqueued, dropped or folded", len(group), event='folded')
+        return embeds, dangerous_embeds
+
+    @staticmethod
+    def _summary(title: str, group: list) -> discord.Embed:
+        lines = []
+        length = 0
+        for i, embed in enumerate(group):
+            line = f"• {embed.fields[0].value if embed.fields else embed.description or ''}"[:200]
+            if length + len(line) > 3900:
+                lines.append(f"…and {len(group) - i} more")
+                break
+            lines.append(line)
+            length += len(line) + 1
+        
+        summary = discord.Embed(
+            title=f"{title} ×{len(group)}",
+            description="\n".join(lines),
+            color=group[0].color,
+            timestamp=datetime.now(pytz.utc)
+        )
+        summary.set_footer(text=f"{len(group)} events within {LOG_BATCH_WINDOW:g}s folded into one summary")
+        return summary
+
+    @staticmethod
+    def _pack(embeds: list):
+        chunk = []
+        chars = 0
+        for embed in embeds:
+            size = len(embed)
+            if chunk and (len(chunk) == MAX_EMBEDS_PER_MESSAGE or chars + size > MAX_EMBED_CHARS_PER_MESSAGE):
+                yield chunk
+                chunk = []
+                chars = 0
+            chunk.append(embed)
+            chars += size
+        if chunk:
+            yield chunk
+
+# Leaderboards
+# Rankings are kept sorted as scores change, so a leaderboard page is a slice
+# instead of a scan and sort over every user.
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_WINDOWS = {
+    'daily': 'today',
+    'weekly': 'this week',
+    'monthly': 'this month',
+    'all': 'all time'
+}
+
+class RankedBoard:
+    """Scores ordered highest first; ties go to the lower id"""
+
+    def __init__(self):
+        self._scores = {}
+        self._ranked = []
+
+    def __len__(self):
+        return len(self._ranked)
+
+    def update(self, key: int, score: int):
+        old = self._scores.get(key)
+        if old == score:
+            return
+        if old is not None:
+            del self._ranked[bisect.bisect_left(self._ranked, (-old, key))]
+        if score > 0:
+            self._scores[key] = score
+            bisect.insort(self._ranked, (-score, key))
+        else:
+            self._scores.pop(key, None)
+
+    def remove(self, key: int):
+        self.update(key, 0)
+
+    def clear(self):
+        self._scores.clear()
+        self._ranked.clear()
+
+    def page(self, page: int, per_page: int = LEADERBOARD_PAGE_SIZE) -> list:
+        start = (page - 1) * per_page
+        return [(key, -score) for score, key in self._ranked[start:start + per_page]]
+
+class LeaderboardIndex:
+    """Online-time boards per window, split into tracked and untracked members,
+    plus the rmute usage board.
+
+    Period boards belong to the current calendar period and are emptied when
+    it rolls over; members then re-enter as they gain time in the new period.
+    Users that are not in the guild are left out until they rejoin.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._boards = {(window, tracked): RankedBoard() for window in LEADERBOARD_WINDOWS for tracked in (True, False)}
+        self._periods = dict.fromkeys(PERIODS)
+        self._partition = {}
+        self.rmute = RankedBoard()
+
+    def rebuild(self, guild: discord.Guild, tracked: set):
+        data = self.state.data
+        for board in self._boards.values():
+            board.clear()
+        self._partition = {
+            int(user_id): int(user_id) in tracked
+            for user_id in data['users']
+            if int(user_id) in tracked or guild.get_member(int(user_id))
+        }
+        now = datetime.now(pytz.utc)
+        self._roll(now)
+        for user_id in self._partition:
+            self.update_user(user_id, data['users'][str(user_id)], now)
+        
+        self.rmute.clear()
+        for moderator_id, count in data['rmute_usage'].items():
+            self.rmute.update(int(moderator_id), count)
+
+    def _roll(self, now: datetime):
+        for period in PERIODS:
+            index = period_index(period, now)
+            if self._periods[period] != index:
+                self._periods[period] = index
+                self._boards[(period, True)].clear()
+                self._boards[(period, False)].clear()
+
+    def _member_partition(self, user_id: int) -> Optional[bool]:
+        """Partition of a user seen for the first time since the last rebuild"""
+        if user_id in self.state.activity.tracked:
+            return True
+        guild = self.state.guild
+        if guild is not None and guild.get_member(user_id):
+            return False
+        return None
+
+    def update_user(self, user_id: int, record: UserRecord, now: datetime = None):
+        tracked = self._partition.get(user_id)
+        if tracked is None:
+            tracked = self._member_partition(user_id)
+            if tracked is None:
+                return
+            self._partition[user_id] = tracked
+        now = now or datetime.now(pytz.utc)
+        self._roll(now)
+        for period in PERIODS:
+            self._boards[(period, tracked)].update(user_id, get_period_seconds(record, period, now))
+        self._boards[('all', tracked)].update(user_id, record.total_online_seconds)
+
+    def set_partition(self, user_id: int, tracked: Optional[bool]):
+        """Move a user between the tracked/untracked boards (None drops them)"""
+        old = self._partition.get(user_id)
+        if old == tracked:
+            return
+        if old is not None:
+            for window in LEADERBOARD_WINDOWS:
+                self._boards[(window, old)].remove(user_id)
+            del self._partition[user_id]
+        if tracked is None:
+            return
+        self._partition[user_id] = tracked
+        record = self.state.data['users'].get(str(user_id))
+        if record is not None:
+            self.update_user(user_id, record)
+
+    def page(self, window: str, tracked: bool, page: int, per_page: int = LEADERBOARD_PAGE_SIZE):
+        """(rows, page count) for one page of an online-time board"""
+        self._roll(datetime.now(pytz.utc))
+        board = self._boards[(window, tracked)]
+        return board.page(page, per_page), max(1, -(-len(board) // per_page))
+
+# Activity tracking
+ONLINE_WINDOW_SECONDS = 60
+
+def has_tracking_role(member) -> bool:
+    config = guild_config(member.guild)
+    return config is not None and any(role.id in config.rcache_roles for role in member.roles)
+
+def add_online_time(state, user_id: int, start: float, end: float):
+    """Credit the online interval [start, end) to counters and history"""
+    seconds = int(end - start)
+    if seconds <= 0:
+        return
+    state.record_activity_history(user_id, start, end)
+    record = state.user_data(user_id)
+    roll_periods(record, datetime.now(pytz.utc))
+    record.total_online_seconds += seconds
+    record.daily_seconds += seconds
+    record.weekly_seconds += seconds
+    record.monthly_seconds += seconds
+    state.mark_dirty('users', str(user_id))
+    state.leaderboards.update_user(user_id, record)
+
+class ActivityTracker:
+    """Event-driven online/offline tracking for members with a tracking role.
+
+    The tracked set is built once when the bot is ready and then kept up to
+    date from role changes. A message from a tracked member marks them
+    online (if they were not already) and pushes their "goes offline at"
+    deadline ONLINE_WINDOW_SECONDS into the future. One timer task sleeps
+    until the earliest deadline, so work scales with active members rather
+    than guild size. The heap holds at most one entry per member; a popped
+    entry whose deadline has since moved is pushed back with the new one.
+    """
+
+    def __init__(self, state, window: int = ONLINE_WINDOW_SECONDS):
+        self.state = state
+        self.window = window
+        self.tracked = set()
+        self._deadlines = {}
+        self._credited_at = {}
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._task = None
+        self._restored = False
+
+    def start(self, guild: discord.Guild):
+        self.tracked = {member.id for member in guild.members if not member.bot and has_tracking_role(member)}
+        if not self._restored:
+            # Once per load; on_ready runs again after every reconnect
+            self._restored = True
+            self._restore_sessions(time.time())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _restore_sessions(self, now: float):
+        """Sessions left open when the bot stopped: one that started within the
+        window keeps the rest of it, any other is closed without credit"""
+        for user_id_str, record in self.state.data['users'].items():
+            if not record.online_start:
+                continue
+            user_id = int(user_id_str)
+            if user_id in self.tracked and now - record.online_start < self.window:
+                self._credited_at[user_id] = now
+                self._schedule(user_id, record.online_start + self.window)
+                continue
+            last_message = record.last_message
+            record.offline_start = max(record.online_start, last_message.timestamp if last_message else 0)
+            record.online_start = None
+            self.state.mark_dirty('users', user_id_str)
+
+    def update_member(self, member: discord.Member):
+        if not member.bot and has_tracking_role(member):
+            self.tracked.add(member.id)
+        else:
+            self.tracked.discard(member.id)
+
+    def remove_member(self, user_id: int):
+        self.tracked.discard(user_id)
+
+    def _schedule(self, user_id: int, deadline: float):
+        had_deadline = user_id in self._deadlines
+        self._deadlines[user_id] = deadline
+        if not had_deadline:
+            heapq.heappush(self._heap, (deadline, user_id))
+            if self._heap[0][1] == user_id:
+                self._wake.set()
+
+    def record_activity(self, member: discord.abc.User, content: str):
+        if member.id not in self.tracked:
+            return
+        
+        now = time.time()
+        record = self.state.user_data(member.id)
+        if record.online_start and member.id in self._credited_at:
+            credited_at = self._credited_at[member.id]
+            elapsed = int(now - credited_at)
+            add_online_time(self.state, member.id, credited_at, credited_at + elapsed)
+            self._credited_at[member.id] += elapsed
+        else:
+            record.online_start = int(now)
+            record.offline_start = None
+            self.state.mark_dirty('users', str(member.id))
+            self._credited_at[member.id] = now
+            
+            embed = discord.Embed(
+                title="🟢 User Online",
+                color=discord.Color.green(),
+                timestamp=datetime.now(pytz.utc)
+            )
+            embed.set_author(name=str(member), icon_url=member.display_avatar.url)
+            embed.add_field(name="User", value=member.mention, inline=False)
+            embed.add_field(name="Last Message", value=(content or 'N/A')[:100], inline=False)
+            self.state.log_queue.put(embed)
+        
+        self._schedule(member.id, now + self.window)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            deadline, user_id = heapq.heappop(self._heap)
+            current = self._deadlines.get(user_id)
+            if current is None:
+                continue
+            if current > deadline:
+                heapq.heappush(self._heap, (current, user_id))
+                continue
+            
+            del self._deadlines[user_id]
+            try:
+                self._go_offline(user_id, deadline)
+            except Exception as e:
+                print(f"❌ Failed to mark {user_id} offline: {e}")
+
+    def _go_offline(self, user_id: int, deadline: float):
+        credited_at = self._credited_at.pop(user_id, deadline)
+        add_online_time(self.state, user_id, credited_at, deadline)
+        
+        record = self.state.user_data(user_id)
+        record.online_start = None
+        record.offline_start = int(deadline)
+        self.state.mark_dirty('users', str(user_id))
+        
+        guild = self.state.guild
+        member = guild.get_member(user_id) if guild else None
+        if member:
+            embed = discord.Embed(
+                title="🔴 User Offline",
+                color=discord.Color.orange(),
+                timestamp=datetime.now(pytz.utc)
+            )
+            embed.set_author(name=str(member), icon_url=member.display_avatar.url)
+            embed.add_field(name="User", value=member.mention, inline=False)
+            self.state.log_queue.put(embed)
+
+# Audit log tail
+AUDIT_TAIL_TTL = 60
+AUDIT_TAIL_WAIT = 1.5
+AUDIT_POLL_DELAY = 0.5
+AUDIT_ENTRY_MAX_AGE = 5
+
+class AuditLogTail:
+    """Short-lived per-guild index of audit log entries keyed by (action, target_id).
+
+    Entries stream in through on_audit_log_entry_create and every handler
+    resolves its executor from here instead of paging guild.audit_logs()
+    itself. Until a guild has streamed an entry (no View Audit Log
+    permission, or nothing happened since startup) lookups fall back to a
+    poll that all handlers in the same burst share.
+    """
+
+    def __init__(self, ttl: float = AUDIT_TAIL_TTL):
+        self.ttl = ttl
+        self._index = {}
+        self._expiry = deque()
+        self._waiters = {}
+        self._live = set()
+        self._polls = {}
+        self.fetches = 0
+
+    def __len__(self):
+        # One expiry per cached entry
+        return len(self._expiry)
+
+    def add(self, entry: discord.AuditLogEntry, from_gateway: bool = False):
+        self._prune()
+        guild_id = entry.guild.id
+        target_id = getattr(entry.target, 'id', None)
+        entries = self._index.setdefault(guild_id, {}).setdefault(entry.action, {}).setdefault(target_id, [])
+        for i, existing in enumerate(entries):
+            if existing.id == entry.id:
+                entries[i] = entry
+                break
+        else:
+            entries.append(entry)
+            self._expiry.append((time.monotonic() + self.ttl, guild_id, entry.action, target_id, entry.id))
+        
+        if from_gateway:
+            self._live.add(guild_id)
+        
+        for future in self._waiters.pop((guild_id, entry.action, target_id), []):
+            if not future.done():
+                future.set_result(entry)
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._expiry and self._expiry[0][0] <= now:
+            _, guild_id, action, target_id, entry_id = self._expiry.popleft()
+            by_action = self._index[guild_id]
+            by_target = by_action[action]
+            entries = [entry for entry in by_target.get(target_id, []) if entry.id != entry_id]
+            if entries:
+                by_target[target_id] = entries
+                continue
+            by_target.pop(target_id, None)
+            if not by_target:
+                del by_action[action]
+                if not by_action:
+                    del self._index[guild_id]
+
+    def is_live(self, guild_id: int) -> bool:
+        return guild_id in self._live
+
+    def find(self, guild_id: int, action: discord.AuditLogAction, target_id: int, max_age: float = AUDIT_ENTRY_MAX_AGE):
+        self._prune()
+        entries = self._index.get(guild_id, {}).get(action, {}).get(target_id)
+        if not entries:
+            return None
+        entry = max(entries, key=lambda e: e.created_at)
+        age = (datetime.now(pytz.utc) - entry.created_at.replace(tzinfo=pytz.utc)).total_seconds()
+        return entry if age <= max_age else None
+
+    def recent(self, guild_id: int, action: discord.AuditLogAction) -> list:
+        self._prune()
+        return [entry for entries in self._index.get(guild_id, {}).get(action, {}).values() for entry in entries]
+
+    async def fetch(self, guild: discord.Guild, action: discord.AuditLogAction, limit: int = 50, delay: float = AUDIT_POLL_DELAY) -> list:
+        """Poll the audit log; callers arriving while a poll is pending share it"""
+        key = (guild.id, action)
+        task = self._polls.get(key)
+        if task is None:
+            task = asyncio.create_task(self._poll(guild, action, limit, delay))
+            self._polls[key] = task
+        return await asyncio.shield(task)
+
+    async def _poll(self, guild: discord.Guild, action: discord.AuditLogAction, limit: int, delay: float) -> list:
+        entries = []
+        try:
+            await asyncio.sleep(delay)
+            self.fetches += 1
+            async for entry in guild.audit_logs(limit=limit, action=action):
+                entries.append(entry)
+                self.add(entry)
+        except Exception as e:
+            print(f"⚠️ Audit log fetch failed: {e}")
+        finally:
+            self._polls.pop((guild.id, action), None)
+        return entries
+
+    async def resolve(self, guild: discord.Guild, action: discord.AuditLogAction, target_id: int, max_age: float = AUDIT_ENTRY_MAX_AGE):
+        entry = self.find(guild.id, action, target_id, max_age)
+        if entry:
+            return entry
+        
+        if not self.is_live(guild.id):
+            await self.fetch(guild, action)
+            return self.find(guild.id, action, target_id, max_age)
+        
+        # Streamed entries can trail the event that caused them by a moment
+        key = (guild.id, action, target_id)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, AUDIT_TAIL_WAIT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._waiters[key]
+
+    async def resolve_user(self, guild: discord.Guild, action: discord.AuditLogAction, target_id: int, max_age: float = AUDIT_ENTRY_MAX_AGE):
+        entry = await self.resolve(guild, action, target_id, max_age)
+        return entry.user if entry else None
+
+audit_tail = AuditLogTail()
+
+# Delete attribution
+DELETE_ATTRIBUTION_WINDOW = 1.5
+
+class DeleteAttributor:
+    """Works out who deleted a message, with at most one audit-log fetch per burst.
+
+    Deletions arriving within DELETE_ATTRIBUTION_WINDOW of the first one in a
+    guild are attributed together. Discord folds repeated deletions of one
+    author's messages in one channel by the same moderator into a single
+    entry and bumps its count, so entries are matched by target and channel
+    and by how much their count grew since they were last seen. Streamed
+    entries from the audit log tail are used first; the log is only fetched
+    when a deletion could have been folded into an existing entry (which
+    does not stream) or the guild is not streaming at all. Self-deletions
+    have no audit entry and resolve to None.
+    """
+
+    def __init__(self, window: float = DELETE_ATTRIBUTION_WINDOW):
+        self.window = window
+        self._pending = {}
+        self._batches = {}
+        self._known = {}
+
+    async def resolve(self, guild: discord.Guild, author_id: int, channel_id: int):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(guild.id, []).append((author_id, channel_id, future))
+        if guild.id not in self._batches:
+            self._batches[guild.id] = asyncio.create_task(self._run_batch(guild))
+        return await future
+
+    async def _run_batch(self, guild: discord.Guild):
+        waiting = []
+        try:
+            await asyncio.sleep(self.window)
+            # Deletions from here on start a new window
+            del self._batches[guild.id]
+            waiting = self._pending.pop(guild.id, [])
+            
+            action = discord.AuditLogAction.message_delete
+            pending = self._assign(waiting, self._budgets(audit_tail.recent(guild.id, action)))
+            if pending and (not audit_tail.is_live(guild.id) or self._may_be_folded(pending)):
+                entries = await audit_tail.fetch(guild, action, limit=min(100, max(5, len(pending))), delay=0)
+                self._assign(pending, self._budgets(entries))
+        except Exception as e:
+            print(f"❌ Failed to attribute deletions in guild {guild.id}: {e}")
+        finally:
+            if self._batches.get(guild.id) is asyncio.current_task():
+                # Cancelled before the window closed
+                del self._batches[guild.id]
+                waiting = self._pending.pop(guild.id, [])
+            # Whatever was not attributed (or failed) resolves to no executor
+            for _, _, future in waiting:
+                if not future.done():
+                    future.set_result(None)
+
+    def _budgets(self, entries: list) -> list:
+        """How many not-yet-attributed deletions each entry accounts for"""
+        now = datetime.now(pytz.utc)
+        budgets = []
+        for entry in entries:
+            count = getattr(entry.extra, 'count', 1) or 1
+            channel = getattr(entry.extra, 'channel', None)
+            channel_id = channel.id if channel else None
+            known = self._known.get(entry.id)
+            if known is None:
+                age = (now - entry.created_at.replace(tzinfo=pytz.utc)).total_seconds()
+                new_deletions = count if age < AUDIT_ENTRY_MAX_AGE + self.window else 0
+            else:
+                new_deletions = count - known[0]
+            self._known.pop(entry.id, None)
+            self._known[entry.id] = (count, entry.target.id, channel_id)
+            if new_deletions > 0:
+                budgets.append([entry.target.id, channel_id, entry.user, new_deletions])
+        
+        while len(self._known) > 500:
+            del self._known[next(iter(self._known))]
+        return budgets
+
+    def _may_be_folded(self, pending: list) -> bool:
+        keys = {(author_id, channel_id) for author_id, channel_id, _ in pending}
+        return any((target_id, channel_id) in keys for _, target_id, channel_id in self._known.values())
+
+    @staticmethod
+    def _assign(pending: list, budgets: list) -> list:
+        unresolved = []
+        for author_id, channel_id, future in pending:
+            for budget in budgets:
+                if budget[3] and budget[0] == author_id and budget[1] in (channel_id, None):
+                    budget[3] -= 1
+                    if not future.done():
+                        future.set_result(budget[2])
+                    break
+            else:
+                unresolved.append((author_id, channel_id, future))
+        return unresolved
+
+delete_attributor = DeleteAttributor()
+
+# Mute pipeline
+MUTE_CONCURRENCY = 5
+
+class DMQueue:
+    """Sends DMs from a background worker so commands never wait on them"""
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, state, user: discord.abc.User, embed: discord.Embed):
+        self._queue.put_nowait((state, user, embed))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
 
-# Flask keep-alive
-app = Flask('')
+    async def _run(self):
+        while not self._queue.empty():
+            state, user, embed = self._queue.get_nowait()
+            await send_dm_safe(state, user, embed)
 
-@app.route('/')
-def home():
-    return "✅ Discord Bot is running!"
+dm_queue = DMQueue()
 
-@app.route('/health')
-def health():
-    return {"status": "healthy", "bot": str(bot.user) if bot.user else "starting"}
+async def _apply_mute(member: discord.Member, mute_role: discord.Role, duration_seconds: int, reason: str,
+                      semaphore: asyncio.Semaphore) -> dict:
+    result = {'member': member, 'error': None, 'warning': None}
+    async with semaphore:
+        try:
+            await member.add_roles(mute_role, reason=reason)
+        except discord.HTTPException as e:
+            result['error'] = f"mute role: {e.text or e}"
+            return result
+        try:
+            await member.timeout(timedelta(seconds=duration_seconds), reason=reason)
+        except discord.HTTPException as e:
+            # The mute role is in place, so the mute still counts
+            result['warning'] = f"timeout: {e.text or e}"
+    return result
+
+async def mute_members(state, members: List[discord.Member], moderator: discord.Member, duration_seconds: int, reason: str) -> list:
+    """Mute members concurrently and return a {'member', 'error', 'warning'} report per target"""
+    guild = moderator.guild
+    data = state.data
+    mute_role = guild.get_role(state.config.mute_role_id)
+    semaphore = asyncio.Semaphore(MUTE_CONCURRENCY)
+    # Greedy converters can yield the same member twice
+    members = list({member.id: member for member in members}.values())
+    results = await asyncio.gather(*(
+        _apply_mute(member, mute_role, duration_seconds, reason, semaphore) for member in members
+    ))
+    
+    now = datetime.now(pytz.utc)
+    unmute_time = now + timedelta(seconds=duration_seconds)
+    start, unmute_at = int(now.timestamp()), int(unmute_time.timestamp())
+    muted = [result['member'] for result in results if result['error'] is None]
+    for member in muted:
+        data['mutes'][str(member.id)] = {
+            'moderator_id': moderator.id,
+            'reason': reason,
+            'duration': duration_seconds,
+            'start_time': start,
+            'unmute_time': unmute_at
+        }
+        state.mark_dirty('mutes', str(member.id))
+        state.add_case(moderator.id, member.id, str(member), reason, duration_seconds, start)
+        
+        dm_embed = discord.Embed(
+            title="🔇 You Have Been Muted",
+            description=f"You have been muted in **{guild.name}**",
+            color=discord.Color.red(),
+            timestamp=now
+        )
+        dm_embed.add_field(name="⚠️ Reason", value=reason, inline=False)
+        dm_embed.add_field(name="⏱️ Duration", value=format_duration(duration_seconds), inline=True)
+        dm_embed.add_field(name="🕐 Unmute Time", value=format_time_in_timezones(unmute_time), inline=False)
+        dm_embed.set_footer(text="Please follow the server rules.")
+        dm_queue.put(state, member, dm_embed)
+        
+        state.unmutes.schedule(member.id, unmute_at)
+    
+    if muted:
+        mod_id_str = str(moderator.id)
+        data['rmute_usage'][mod_id_str] = data['rmute_usage'].get(mod_id_str, 0) + len(muted)
+        state.mark_dirty('rmute_usage', mod_id_str)
+        state.leaderboards.rmute.update(moderator.id, data['rmute_usage'][mod_id_str])
+    
+    tracking_channel = bot.get_channel(state.config.mute_log_channel_id)
+    if tracking_channel:
+        await tracking_channel.send(embed=mute_summary_embed(results, moderator, duration_seconds, reason, unmute_time))
+    return results
+
+def _chunk_lines(lines: list, limit: int = 1024) -> list:
+    chunks = []
+    current = ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line[:limit]
+    if current:
+        chunks.append(current)
+    return chunks
+
+def mute_summary_embed(results: list, moderator: discord.Member, duration_seconds: int, reason: str, unmute_time: datetime) -> discord.Embed:
+    muted = [result for result in results if result['error'] is None]
+    failed = [result for result in results if result['error'] is not None]
+    
+    embed = discord.Embed(
+        title="🔨 User Muted" if len(results) == 1 and muted else f"🔨 {len(muted)} Users Muted",
+        color=discord.Color.red(),
+        timestamp=datetime.now(pytz.utc)
+    )
+    if len(muted) == 1:
+        embed.set_thumbnail(url=muted[0]['member'].display_avatar.url)
+    
+    user_lines = [
+        f"{result['member'].mention} ({result['member']})" + (f" ⚠️ {result['warning']}" if result['warning'] else "")
+        for result in muted
+    ]
+    # An embed holds at most 25 fields; leave room for the fixed ones
+    for i, chunk in enumerate(_chunk_lines(user_lines)[:15]):
+        embed.add_field(name="👤 User" if len(muted) == 1 else ("👤 Users" if i == 0 else "👤 Users (cont.)"), value=chunk, inline=False)
+    embed.add_field(name="👮 Moderator", value=moderator.mention, inline=False)
+    embed.add_field(name="⚠️ Reason", value=reason, inline=False)
+    embed.add_field(name="⏱️ Duration", value=format_duration(duration_seconds), inline=True)
+    embed.add_field(name="🕐 Unmute Time", value=format_time_in_timezones(unmute_time), inline=False)
+    if failed:
+        failure_lines = [f"{result['member'].mention}: {result['error']}" for result in failed]
+        embed.add_field(name=f"❌ Failed ({len(failed)})", value=_chunk_lines(failure_lines)[0], inline=False)
+    return embed
+
+async def log_deleted_message(state, guild: Optional[discord.Guild], author_id: int, author_label: str, channel_id: int,
+                              created_at: datetime, content: str, attachments: list, embed_count: int):
+    message_age = datetime.now(pytz.utc) - created_at.replace(tzinfo=pytz.utc)
+    deleter = await delete_attributor.resolve(guild, author_id, channel_id) if guild else None
+    
+    fields = [
+        {"name": "👤 Author", "value": f"<@{author_id}> ({author_label})", "inline": False},
+        {"name": "📍 Channel", "value": f"<#{channel_id}>", "inline": True},
+        {"name": "⏰ Message Age", "value": format_duration(int(message_age.total_seconds())), "inline": True}
+    ]
+    
+    if deleter:
+        fields.append({"name": "🗑️ Deleted By", "value": f"{deleter.mention} ({deleter})", "inline": False})
+    
+    if content:
+        fields.append({"name": "📝 Content", "value": content[:1024], "inline": False})
+    
+    if attachments:
+        fields.append({"name": "📎 Attachments", "value": "\n".join(attachments[:5]), "inline": False})
+    
+    if embed_count:
+        fields.append({"name": "📊 Embeds", "value": f"{embed_count} embed(s)", "inline": False})
+    
+    await log_action(
+        state,
+        title="🗑️ Message Deleted",
+        color=discord.Color.red(),
+        fields=fields
+    )
+
+# Purge archives
+PURGE_LOG_FORMAT = os.getenv('PURGE_LOG_FORMAT', 'txt').lower()
+PURGE_LOG_FORMATS = ('txt', 'txt.gz', 'jsonl', 'jsonl.gz')
+
+def snapshot_purge(messages: list) -> list:
+    """Plain (author, author_id, created_at, content, attachment urls) rows, safe to format off the event loop"""
+    return [
+        (str(msg.author), msg.author.id, msg.created_at, msg.content, [att.url for att in msg.attachments])
+        for msg in messages
+    ]
+
+def build_purge_archive(header: dict, rows: list, fmt: str = PURGE_LOG_FORMAT) -> bytes:
+    """Render a purge archive into one buffer; runs in a worker thread"""
+    out = io.StringIO()
+    if fmt.startswith('jsonl'):
+        out.write(json.dumps(header))
+        out.write("\n")
+        for author, author_id, created_at, content, attachments in rows:
+            out.write(json.dumps({
+                'author': author,
+                'author_id': author_id,
+                'created_at': created_at.isoformat(),
+                'content': content,
+                'attachments': attachments
+            }))
+            out.write("\n")
+    else:
+        out.write("Bulk Message Deletion Log\n")
+        out.write(f"Total Messages: {header['total']}\n")
+        out.write(f"Channel: {header['channel']}\n")
+        if header.get('deleted_by'):
+            out.write(f"Deleted By: {header['deleted_by']} (ID: {header['deleted_by_id']})\n")
+        out.write(f"Time: {header['time']}\n")
+        out.write(f"Bot Used: {header['bot']}\n")
+        out.write("\n" + "="*50 + "\n\n")
+        for author, author_id, created_at, content, attachments in rows:
+            out.write(f"Author: {author} (ID: {author_id})\n")
+            out.write(f"Time: {created_at.strftime('%Y-%m-%d %H:%M:%S UTC')}\n")
+            out.write(f"Content: {content}\n")
+            if attachments:
+                out.write(f"Attachments: {', '.join(attachments)}\n")
+            out.write("\n" + "-"*30 + "\n\n")
+    
+    payload = out.getvalue().encode()
+    if fmt.endswith('.gz'):
+        payload = gzip.compress(payload, compresslevel=6)
+    return payload
 
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
+# Unmute scheduler
+UNMUTE_CONCURRENCY = 5
 
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
+class UnmuteScheduler:
+    """Durable auto-unmutes driven by a guild's data['mutes'][*]['unmute_time'].
+
+    One timer task sleeps until the earliest deadline in a min-heap. Mutes
+    are loaded from the guild's data when the bot is ready, so anything that came
+    due while it was down is unmuted in one batch. Cancelling (runmute) or
+    re-muting only updates the deadline map; stale heap entries are skipped
+    when they surface.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._deadlines = {}
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def start(self):
+        for user_id, mute in self.state.data['mutes'].items():
+            if mute.get('unmute_time'):
+                self.schedule(int(user_id), mute['unmute_time'])
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def schedule(self, user_id: int, deadline: int):
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id))
+        if self._heap[0][1] == user_id:
+            self._wake.set()
+
+    def cancel(self, user_id: int):
+        self._deadlines.pop(user_id, None)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) == deadline:
+                del self._deadlines[user_id]
+                due.append(user_id)
+        return due
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self._unmute_batch(due)
+                except Exception as e:
+                    print(f"❌ Auto-unmute batch failed for guild {self.state.guild_id}: {e}")
+                continue
+            
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _unmute_batch(self, user_ids: list):
+        guild = self.state.guild
+        if guild is None:
+            return
+        mute_role = guild.get_role(self.state.config.mute_role_id)
+        semaphore = asyncio.Semaphore(UNMUTE_CONCURRENCY)
+        unmuted = await asyncio.gather(*(self._unmute(guild, mute_role, user_id, semaphore) for user_id in user_ids))
+        unmuted = [entry for entry in unmuted if entry is not None]
+        
+        tracking_channel = guild.get_channel(self.state.config.mute_log_channel_id)
+        if tracking_channel and unmuted:
+            await tracking_channel.send(embed=self._log_embed(unmuted))
+
+    async def _unmute(self, guild: discord.Guild, mute_role: Optional[discord.Role], user_id: int, semaphore: asyncio.Semaphore):
+        mute = self.state.data['mutes'].pop(str(user_id), None)
+        if mute is None:
+            return None
+        self.state.mark_dirty('mutes', str(user_id))
+        
+        member = guild.get_member(user_id)
+        if member is None:
+            # Nothing to unmute, but say why the mute is gone
+            await log_action(
+                self.state,
+                title="🔓 Mute Expired While Absent",
+                description=f"<@{user_id}>'s mute expired while they were not in the server",
+                color=discord.Color.light_grey(),
+                fields=[
+                    {"name": "🆔 User ID", "value": str(user_id), "inline": True},
+                    {"name": "👮 Muted By", "value": f"<@{mute['moderator_id']}>" if mute.get('moderator_id') else "Unknown", "inline": True},
+                    {"name": "📝 Reason", "value": (mute.get('reason') or 'N/A')[:1024], "inline": False}
+                ]
+            )
+            return None
+        if not mute_role or mute_role not in member.roles:
+            return None
+        
+        async with semaphore:
+            try:
+                await member.remove_roles(mute_role, reason="Auto-unmute")
+            except discord.HTTPException as e:
+                print(f"❌ Failed to auto-unmute {member}: {e}")
+                return None
+            if member.timed_out_until:
+                try:
+                    await member.timeout(None, reason="Auto-unmute")
+                except discord.HTTPException:
+                    pass
+        
+        dm_embed = discord.Embed(
+            title="🔓 You Have Been Unmuted",
+            description=f"Your mute in **{guild.name}** has expired",
+            color=discord.Color.green(),
+            timestamp=datetime.now(pytz.utc)
+        )
+        dm_embed.add_field(name="Original Reason", value=mute.get('reason') or 'N/A', inline=False)
+        dm_embed.set_footer(text="Remember to follow server rules.")
+        dm_queue.put(self.state, member, dm_embed)
+        return member, mute
+
+    @staticmethod
+    def _log_embed(unmuted: list) -> discord.Embed:
+        if len(unmuted) == 1:
+            member, mute = unmuted[0]
+            embed = discord.Embed(
+                title="🔓 Auto-Unmute",
+                description=f"{member.mention} has been automatically unmuted",
+                color=discord.Color.green(),
+                timestamp=datetime.now(pytz.utc)
+            )
+            embed.add_field(name="Original Reason", value=mute.get('reason') or 'N/A', inline=False)
+            embed.add_field(name="Muted By", value=f"<@{mute.get('moderator_id')}>", inline=True)
+            embed.add_field(name="Duration", value=format_duration(mute.get('duration') or 0), inline=True)
+            return embed
+        
+        embed = discord.Embed(
+            title=f"🔓 Auto-Unmute ({len(unmuted)} users)",
+            description="These mutes expired and have been lifted",
+            color=discord.Color.green(),
+            timestamp=datetime.now(pytz.utc)
+        )
+        lines = [
+            f"{member.mention} - muted by <@{mute.get('moderator_id')}> for {format_duration(mute.get('duration') or 0)}"
+            for member, mute in unmuted
+        ]
+        for i, chunk in enumerate(_chunk_lines(lines)[:25]):
+            embed.add_field(name="Users" if i == 0 else "Users (cont.)", value=chunk, inline=False)
+        return embed
 
 # Events
 @bot.event
 async def on_ready():
     print(f'✅ Bot logged in as {bot.user}')
-    print(f'📊 Tracking {len(bot_data["users"])} users')
-    if not timetrack_loop.is_running():
-        timetrack_loop.start()
+    if SHARDED:
+        print(f'🧩 Running shards {sorted(bot.shards)} of {bot.shard_count}')
+    # Guild data loads in worker threads, so large shards load side by side
+    states = await asyncio.gather(*(guild_states.get(guild) for guild in bot.guilds))
+    report_startup('ready')
     if not auto_save.is_running():
         auto_save.start()
+    if not activity_retention.is_running():
+        activity_retention.start()
+    
+    started = []
+    for guild, state in zip(bot.guilds, states):
+        if state is None:
+            continue
+        print(f'📊 Tracking {len(state.data["users"])} users in {guild.name}')
+        started.append(state.start(guild))
+    await asyncio.gather(*started)
+    report_startup('members_cached')
+
+@bot.event
+async def on_guild_join(guild):
+    state = await guild_states.get(guild)
+    if state is not None:
+        await state.start(guild)
+
+def record_shard_event(shard_id: int, event: str):
+    metrics.inc('discord_shard_events_total', "Gateway connection events per shard", shard=shard_id, event=event)
+    print(f"🧩 Shard {shard_id}: {event}")
+
+@bot.event
+async def on_shard_connect(shard_id):
+    record_shard_event(shard_id, 'connect')
+
+@bot.event
+async def on_shard_ready(shard_id):
+    record_shard_event(shard_id, 'ready')
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    record_shard_event(shard_id, 'resumed')
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    record_shard_event(shard_id, 'disconnect')
 
 @bot.event
 async def on_message(message):
     if message.author.bot:
         return
     
-    user_data = get_user_data(message.author.id)
-    user_data['last_message'] = {
-        'content': message.content,
-        'timestamp': datetime.now(pytz.utc).isoformat(),
-        'channel_id': message.channel.id
-    }
-    
-    bot_data['cached_messages'].append({
-        'id': message.id,
-        'author_id': message.author.id,
-        'author_name': str(message.author),
-        'content': message.content,
-        'attachments': [att.url for att in message.attachments],
-        'embeds': [e.to_dict() for e in message.embeds],
-        'channel_id': message.channel.id,
-        'timestamp': datetime.now(pytz.utc).isoformat(),
-        'reference': message.reference.message_id if message.reference else None,
-        'created_at': message.created_at.isoformat()
-    })
-    
-    if len(bot_data['cached_messages']) > 2000:
-        bot_data['cached_messages'] = bot_data['cached_messages'][-2000:]
-    
-    save_data()
+    state = await guild_states.get(message.guild)
+    if state is not None:
+        cached = CachedMessage.from_message(message)
+        state.data['cached_messages'].append(cached)
+        state.user_data(message.author.id).last_message = cached
+        state.activity.record_activity(message.author, message.content)
+        
+        state.mark_dirty('users', str(message.author.id))
+        state.mark_dirty('cached_messages', message.id)
     await bot.process_commands(message)
 
+@bot.event
+async def on_audit_log_entry_create(entry):
+    audit_tail.add(entry, from_gateway=True)
+
 @bot.event
 async def on_message_delete(message):
     if message.author.bot:
         return
+    state = await guild_states.get(message.guild)
+    if state is None:
+        return
     
-    message_age = datetime.now(pytz.utc) - message.created_at.replace(tzinfo=pytz.utc)
-    
-    deleter = None
-    try:
-        guild = message.guild
-        async for entry in guild.audit_logs(limit=5, action=discord.AuditLogAction.message_delete):
-            if entry.target.id == message.author.id:
-                if (datetime.now(pytz.utc) - entry.created_at.replace(tzinfo=pytz.utc)).total_seconds() < 5:
-                    deleter = entry.user
-                    break
-    except:
-        pass
-    
-    fields = [
-        {"name": "👤 Author", "value": f"{message.author.mention} ({message.author})", "inline": False},
-        {"name": "📍 Channel", "value": message.channel.mention, "inline": True},
-        {"name": "⏰ Message Age", "value": format_duration(int(message_age.total_seconds())), "inline": True}
-    ]
-    
-    if deleter:
-        fields.append({"name": "🗑️ Deleted By", "value": f"{deleter.mention} ({deleter})", "inline": False})
-    
-    if message.content:
-        fields.append({"name": "📝 Content", "value": message.content[:1024], "inline": False})
-    
-    if message.attachments:
-        attachments = "\n".join([att.url for att in message.attachments][:5])
-        fields.append({"name": "📎 Attachments", "value": attachments, "inline": False})
+    await log_deleted_message(
+        state,
+        message.guild,
+        message.author.id,
+        str(message.author),
+        message.channel.id,
+        message.created_at,
+        message.content,
+        [att.url for att in message.attachments],
+        len(message.embeds)
+    )
+
+@bot.event
+async def on_raw_message_delete(payload):
+    # Messages discord.py still had cached are handled by on_message_delete
+    if payload.cached_message is not None or payload.guild_id is None:
+        return
     
-    if message.embeds:
-        fields.append({"name": "📊 Embeds", "value": f"{len(message.embeds)} embed(s)", "inline": False})
+    guild = bot.get_guild(payload.guild_id)
+    state = await guild_states.get(guild) if guild else None
+    cached = state.data['cached_messages'].get(payload.message_id) if state else None
+    if cached is None:
+        return
     
-    await log_action(
-        title="🗑️ Message Deleted",
-        color=discord.Color.red(),
-        fields=fields
+    await log_deleted_message(
+        state,
+        guild,
+        cached.author_id,
+        cached.author_name,
+        cached.channel_id,
+        datetime.fromtimestamp(cached.created_at, pytz.utc),
+        cached.content,
+        cached.attachments,
+        cached.embeds
     )
 
 @bot.event
 async def on_message_edit(before, after):
     if before.author.bot or before.content == after.content:
         return
+    state = await guild_states.get(before.guild)
+    if state is None:
+        return
     
-    user_data = get_user_data(before.author.id)
-    user_data['last_edit'] = datetime.now(pytz.utc).isoformat()
-    save_data()
+    state.user_data(before.author.id).last_edit = int(time.time())
+    state.mark_dirty('users', str(before.author.id))
     
     await log_action(
+        state,
         title="✏️ Message Edited",
         color=discord.Color.orange(),
         fields=[
@@ -315,7 +3422,13 @@ async def on_message_edit(before, after):
 
 @bot.event
 async def on_member_join(member):
+    state = await guild_states.get(member.guild)
+    if state is None:
+        return
+    if not member.bot:
+        state.leaderboards.set_partition(member.id, False)
     await log_action(
+        state,
         title="👋 Member Joined",
         color=discord.Color.green(),
         fields=[
@@ -328,7 +3441,13 @@ async def on_member_join(member):
 
 @bot.event
 async def on_member_remove(member):
+    state = await guild_states.get(member.guild)
+    if state is None:
+        return
+    state.activity.remove_member(member.id)
+    state.leaderboards.set_partition(member.id, None)
     await log_action(
+        state,
         title="👋 Member Left",
         color=discord.Color.red(),
         fields=[
@@ -341,16 +3460,17 @@ async def on_member_remove(member):
 
 @bot.event
 async def on_member_update(before, after):
-    executor = None
-    try:
-        async for entry in after.guild.audit_logs(limit=1):
-            if (datetime.now(pytz.utc) - entry.created_at.replace(tzinfo=pytz.utc)).total_seconds() < 3:
-                executor = entry.user
-                break
-    except:
-        pass
+    nick_changed = before.nick != after.nick
+    roles_changed = before.roles != after.roles
+    timeout_changed = before.timed_out_until != after.timed_out_until
+    if not (nick_changed or roles_changed or timeout_changed):
+        return
+    state = await guild_states.get(after.guild)
+    if state is None:
+        return
     
-    if before.nick != after.nick:
+    if nick_changed:
+        executor = await audit_tail.resolve_user(after.guild, discord.AuditLogAction.member_update, after.id)
         fields = [
             {"name": "👤 Member", "value": f"{after.mention} ({after})", "inline": False},
             {"name": "📝 Old Nickname", "value": before.nick or "None", "inline": True},
@@ -360,12 +3480,16 @@ async def on_member_update(before, after):
             fields.append({"name": "✏️ Changed By", "value": f"{executor.mention} ({executor})", "inline": False})
         
         await log_action(
+            state,
             title="✏️ Nickname Changed",
             color=discord.Color.blue(),
             fields=fields
         )
     
-    if before.roles != after.roles:
+    if roles_changed:
+        state.activity.update_member(after)
+        state.leaderboards.set_partition(after.id, after.id in state.activity.tracked)
+        executor = await audit_tail.resolve_user(after.guild, discord.AuditLogAction.member_role_update, after.id)
         added_roles = [role for role in after.roles if role not in before.roles]
         removed_roles = [role for role in before.roles if role not in after.roles]
         
@@ -381,12 +3505,14 @@ async def on_member_update(before, after):
             fields.append({"name": "👮 Modified By", "value": f"{executor.mention} ({executor})", "inline": False})
         
         await log_action(
+            state,
             title="🎭 Member Roles Updated",
             color=discord.Color.purple(),
             fields=fields
         )
     
-    if before.timed_out_until != after.timed_out_until:
+    if timeout_changed:
+        executor = await audit_tail.resolve_user(after.guild, discord.AuditLogAction.member_update, after.id)
         if after.timed_out_until and after.timed_out_until > datetime.now(pytz.utc):
             duration = (after.timed_out_until.replace(tzinfo=pytz.utc) - datetime.now(pytz.utc)).total_seconds()
             fields = [
@@ -398,6 +3524,7 @@ async def on_member_update(before, after):
                 fields.append({"name": "👮 Muted By", "value": f"{executor.mention} ({executor})", "inline": False})
             
             await log_action(
+                state,
                 title="🔇 Member Timed Out (External)",
                 color=discord.Color.red(),
                 fields=fields
@@ -408,6 +3535,7 @@ async def on_member_update(before, after):
                 fields.append({"name": "🔓 Unmuted By", "value": f"{executor.mention} ({executor})", "inline": False})
             
             await log_action(
+                state,
                 title="🔓 Timeout Removed (External)",
                 color=discord.Color.green(),
                 fields=fields
@@ -415,16 +3543,12 @@ async def on_member_update(before, after):
 
 @bot.event
 async def on_member_ban(guild, user):
-    executor = None
-    reason = None
-    try:
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.ban):
-            if entry.target.id == user.id:
-                executor = entry.user
-                reason = entry.reason
-                break
-    except:
-        pass
+    state = await guild_states.get(guild)
+    if state is None:
+        return
+    entry = await audit_tail.resolve(guild, discord.AuditLogAction.ban, user.id, max_age=30)
+    executor = entry.user if entry else None
+    reason = entry.reason if entry else None
     
     fields = [
         {"name": "👤 User", "value": f"{user.mention} ({user})", "inline": False},
@@ -438,6 +3562,7 @@ async def on_member_ban(guild, user):
         fields.append({"name": "📝 Reason", "value": reason, "inline": False})
     
     await log_action(
+        state,
         title="🔨 Member Banned",
         color=discord.Color.dark_red(),
         fields=fields,
@@ -446,14 +3571,10 @@ async def on_member_ban(guild, user):
 
 @bot.event
 async def on_member_unban(guild, user):
-    executor = None
-    try:
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.unban):
-            if entry.target.id == user.id:
-                executor = entry.user
-                break
-    except:
-        pass
+    state = await guild_states.get(guild)
+    if state is None:
+        return
+    executor = await audit_tail.resolve_user(guild, discord.AuditLogAction.unban, user.id, max_age=30)
     
     fields = [
         {"name": "👤 User", "value": f"{user.mention} ({user})", "inline": False},
@@ -464,6 +3585,7 @@ async def on_member_unban(guild, user):
         fields.append({"name": "🔓 Unbanned By", "value": f"{executor.mention} ({executor})", "inline": False})
     
     await log_action(
+        state,
         title="🔓 Member Unbanned",
         color=discord.Color.green(),
         fields=fields
@@ -471,15 +3593,6 @@ async def on_member_unban(guild, user):
 
 @bot.event
 async def on_guild_channel_update(before, after):
-    executor = None
-    try:
-        async for entry in after.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_update):
-            if entry.target.id == after.id:
-                executor = entry.user
-                break
-    except:
-        pass
-    
     changes = []
     
     if before.name != after.name:
@@ -496,7 +3609,9 @@ async def on_guild_channel_update(before, after):
     if before.overwrites != after.overwrites:
         changes.append("**Permissions Modified**")
     
-    if changes:
+    state = await guild_states.get(after.guild)
+    if changes and state is not None:
+        executor = await audit_tail.resolve_user(after.guild, discord.AuditLogAction.channel_update, after.id, max_age=30)
         fields = [
             {"name": "Channel", "value": after.mention, "inline": False},
             {"name": "Changes", "value": "\n".join(changes), "inline": False}
@@ -506,6 +3621,7 @@ async def on_guild_channel_update(before, after):
             fields.append({"name": "✏️ Modified By", "value": f"{executor.mention} ({executor})", "inline": False})
         
         await log_action(
+            state,
             title="✏️ Channel Updated",
             color=discord.Color.orange(),
             fields=fields
@@ -513,37 +3629,27 @@ async def on_guild_channel_update(before, after):
 
 @bot.event
 async def on_bulk_message_delete(messages):
-    executor = None
-    try:
-        guild = messages[0].guild if messages else None
-        if guild:
-            async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.message_bulk_delete):
-                executor = entry.user
-                break
-    except:
-        pass
+    guild = messages[0].guild if messages else None
+    state = await guild_states.get(guild) if guild else None
+    if state is None:
+        return
+    executor = await audit_tail.resolve_user(guild, discord.AuditLogAction.message_bulk_delete, messages[0].channel.id, max_age=30)
     
     if len(messages) >= 20:
-        file_content = f"Bulk Message Deletion Log\n"
-        file_content += f"Total Messages: {len(messages)}\n"
-        file_content += f"Channel: {messages[0].channel.name if messages else 'Unknown'}\n"
-        if executor:
-            file_content += f"Deleted By: {executor} (ID: {executor.id})\n"
-        file_content += f"Time: {datetime.now(pytz.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}\n"
-        file_content += f"Bot Used: {bot.user}\n"
-        file_content += "\n" + "="*50 + "\n\n"
-        
-        for msg in messages:
-            file_content += f"Author: {msg.author} (ID: {msg.author.id})\n"
-            file_content += f"Time: {msg.created_at.strftime('%Y-%m-%d %H:%M:%S UTC')}\n"
-            file_content += f"Content: {msg.content}\n"
-            if msg.attachments:
-                file_content += f"Attachments: {', '.join([att.url for att in msg.attachments])}\n"
-            file_content += "\n" + "-"*30 + "\n\n"
-        
-        file = discord.File(io.BytesIO(file_content.encode()), filename=f"purge_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+        now = datetime.now(pytz.utc)
+        header = {
+            'total': len(messages),
+            'channel': messages[0].channel.name,
+            'deleted_by': str(executor) if executor else None,
+            'deleted_by_id': executor.id if executor else None,
+            'time': now.strftime('%Y-%m-%d %H:%M:%S UTC'),
+            'bot': str(bot.user)
+        }
+        fmt = PURGE_LOG_FORMAT if PURGE_LOG_FORMAT in PURGE_LOG_FORMATS else 'txt'
+        file_bytes = await asyncio.to_thread(build_purge_archive, header, snapshot_purge(messages), fmt)
+        filename = f"purge_{now.strftime('%Y%m%d_%H%M%S')}.{fmt}"
         
-        log_channel = bot.get_channel(MUTE_LOG_CHANNEL_ID)
+        log_channel = bot.get_channel(state.config.mute_log_channel_id)
         if log_channel:
             embed = discord.Embed(
                 title="🗑️ Bulk Message Delete (Purge)",
@@ -558,15 +3664,12 @@ async def on_bulk_message_delete(messages):
             
             embed.add_field(name="📄 Full Log", value="See attached file for complete message history", inline=False)
             
-            await log_channel.send(embed=embed, file=file)
-            
-            for user_id in DANGEROUS_LOG_USERS:
-                try:
-                    user = await bot.fetch_user(user_id)
-                    file2 = discord.File(io.BytesIO(file_content.encode()), filename=f"purge_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
-                    await user.send(embed=embed, file=file2)
-                except:
-                    pass
+            await broadcaster.send(
+                [log_channel, *state.config.dangerous_log_users],
+                embed=embed,
+                # BytesIO over immutable bytes shares the buffer instead of copying it
+                file_factory=lambda: discord.File(io.BytesIO(file_bytes), filename=filename)
+            )
     else:
         message_info = []
         for msg in list(messages)[:10]:
@@ -582,6 +3685,7 @@ async def on_bulk_message_delete(messages):
             fields.append({"name": "🗑️ Purged By", "value": f"{executor.mention} ({executor})", "inline": False})
         
         await log_action(
+            state,
             title="🗑️ Bulk Message Delete (Purge)",
             description=f"{len(messages)} messages were deleted",
             color=discord.Color.red(),
@@ -589,88 +3693,6 @@ async def on_bulk_message_delete(messages):
             dangerous=True
         )
 
-@tasks.loop(seconds=60)
-async def timetrack_loop():
-    guild = bot.get_guild(GUILD_ID)
-    if not guild:
-        return
-    
-    tracking_channel = bot.get_channel(MUTE_LOG_CHANNEL_ID)
-    now = datetime.now(pytz.utc)
-    
-    for member in guild.members:
-        if member.bot:
-            continue
-        
-        has_tracking_role = any(role.id in RCACHE_ROLES for role in member.roles)
-        if not has_tracking_role:
-            continue
-        
-        user_data = get_user_data(member.id)
-        
-        if user_data.get('last_message'):
-            last_msg_time = datetime.fromisoformat(user_data['last_message']['timestamp'])
-            time_since_msg = (now - last_msg_time).total_seconds()
-            
-            if time_since_msg <= 53:
-                if user_data.get('online_start'):
-                    user_data['total_online_seconds'] += 60
-                    user_data['daily_seconds'] += 60
-                    user_data['weekly_seconds'] += 60
-                    user_data['monthly_seconds'] += 60
-                else:
-                    user_data['online_start'] = now.isoformat()
-                    user_data['offline_start'] = None
-                    
-                    if tracking_channel:
-                        embed = discord.Embed(
-                            title="🟢 User Online",
-                            color=discord.Color.green(),
-                            timestamp=now
-                        )
-                        embed.set_author(name=str(member), icon_url=member.display_avatar.url)
-                        embed.add_field(name="User", value=member.mention, inline=False)
-                        if user_data.get('last_message'):
-                            embed.add_field(name="Last Message", value=user_data['last_message'].get('content', 'N/A')[:100], inline=False)
-                        await tracking_channel.send(embed=embed)
-            else:
-                if user_data.get('online_start'):
-                    user_data['online_start'] = None
-                    user_data['offline_start'] = now.isoformat()
-                    
-                    if tracking_channel:
-                        embed = discord.Embed(
-                            title="🔴 User Offline",
-                            color=discord.Color.orange(),
-                            timestamp=now
-                        )
-                        embed.set_author(name=str(member), icon_url=member.display_avatar.url)
-                        embed.add_field(name="User", value=member.mention, inline=False)
-                        await tracking_channel.send(embed=embed)
-    
-    for user_id, user_data in bot_data['users'].items():
-        last_resets = user_data.get('last_reset', {})
-        
-        if last_resets.get('daily'):
-            last_daily = datetime.fromisoformat(last_resets['daily'])
-            if (now - last_daily).days >= 1:
-                user_data['daily_seconds'] = 0
-                user_data['last_reset']['daily'] = now.isoformat()
-        
-        if last_resets.get('weekly'):
-            last_weekly = datetime.fromisoformat(last_resets['weekly'])
-            if (now - last_weekly).days >= 7:
-                user_data['weekly_seconds'] = 0
-                user_data['last_reset']['weekly'] = now.isoformat()
-        
-        if last_resets.get('monthly'):
-            last_monthly = datetime.fromisoformat(last_resets['monthly'])
-            if (now - last_monthly).days >= 30:
-                user_data['monthly_seconds'] = 0
-                user_data['last_reset']['monthly'] = now.isoformat()
-    
-    save_data()
-
 @bot.command(name='rhelp')
 async def rhelp(ctx):
     if not has_mod_role(ctx.author):
@@ -682,30 +3704,40 @@ async def rhelp(ctx):
         color=discord.Color.blue()
     )
     
-    embed.add_field(name="!timetrack [user]", value="Shows detailed online/offline tracking stats", inline=False)
+    embed.add_field(name="!timetrack [user] [range]", value="Shows detailed online/offline tracking stats, with history for a range like 7d", inline=False)
+    embed.add_field(name="!twho [date] [start] [end]", value="Who was online on a UTC date/time range", inline=False)
     embed.add_field(name="!rmute [users] [duration] [reason]", value="Mute multiple users", inline=False)
     embed.add_field(name="!runmute [user] [reason]", value="Unmute a user", inline=False)
-    embed.add_field(name="!rmlb", value="RMute usage leaderboard", inline=False)
-    embed.add_field(name="!rmal [moderator]", value="Show all mutes by a moderator", inline=False)
-    embed.add_field(name="!rml", value="Show your mute history", inline=False)
+    embed.add_field(name="!rmlb [page]", value="RMute usage leaderboard", inline=False)
+    embed.add_field(name="!rmal [moderator] [filters]", value="Show all mutes by a moderator", inline=False)
+    embed.add_field(name="!rml [filters]", value="Show your mute history", inline=False)
+    embed.add_field(name="Mute filters", value="reason:word since:7d until:2024-01-31 min:1h max:1d user:@user page:2", inline=False)
     embed.add_field(name="!rcache", value="Show recently deleted messages", inline=False)
-    embed.add_field(name="!tlb", value="Timetrack leaderboard (tracked roles)", inline=False)
-    embed.add_field(name="!tdm", value="Timetrack leaderboard (non-tracked roles)", inline=False)
+    embed.add_field(name="!rsearch [words] [filters]", value="Search cached messages (author:, channel:, since:, until:)", inline=False)
+    embed.add_field(name="!tlb [daily|weekly|monthly|all] [page]", value="Timetrack leaderboard (tracked roles)", inline=False)
+    embed.add_field(name="!tdm [daily|weekly|monthly|all] [page]", value="Timetrack leaderboard (non-tracked roles)", inline=False)
     embed.add_field(name="!sping / !hsping", value="Ping staff roles", inline=False)
+    embed.add_field(name="!rtraces [count]", value="Show recent slow handler traces", inline=False)
     embed.add_field(name="!rdm", value="Toggle DM notifications", inline=False)
     
     embed.set_footer(text="Moderator-only commands")
     await ctx.send(embed=embed)
 
 @bot.command(name='timetrack')
-async def timetrack(ctx, member: discord.Member = None):
+async def timetrack(ctx, member: Optional[discord.Member] = None, lookback: str = None):
     if not has_mod_role(ctx.author):
         return
     
     if member is None:
         member = ctx.author
     
-    user_data = get_user_data(member.id)
+    lookback_seconds = parse_duration(lookback) if lookback else 0
+    if lookback and lookback_seconds <= 0:
+        await ctx.send("❌ Invalid range! Use format like: 12h, 7d, 30d")
+        return
+    
+    state = await guild_states.get(ctx.guild)
+    record = state.user_data(member.id)
     now = datetime.now(pytz.utc)
     
     embed = discord.Embed(
@@ -715,35 +3747,34 @@ async def timetrack(ctx, member: discord.Member = None):
     )
     embed.set_thumbnail(url=member.display_avatar.url)
     
-    if user_data.get('online_start'):
-        online_duration = int((now - datetime.fromisoformat(user_data['online_start'])).total_seconds())
+    if record.online_start:
+        online_duration = int(now.timestamp()) - record.online_start
         embed.add_field(name="🟢 Status", value=f"Online for {format_duration(online_duration)}", inline=False)
-    elif user_data.get('offline_start'):
-        offline_duration = int((now - datetime.fromisoformat(user_data['offline_start'])).total_seconds())
+    elif record.offline_start:
+        offline_duration = int(now.timestamp()) - record.offline_start
         embed.add_field(name="🔴 Status", value=f"Offline for {format_duration(offline_duration)}", inline=False)
     else:
         embed.add_field(name="Status", value="Unknown", inline=False)
     
-    if user_data.get('last_message'):
-        last_msg = user_data['last_message']
-        msg_time = datetime.fromisoformat(last_msg['timestamp'])
+    if record.last_message:
+        last_msg = record.last_message
         embed.add_field(
             name="💬 Last Message",
-            value=f"{last_msg.get('content', 'N/A')[:100]}\n\n{format_time_in_timezones(msg_time)}",
+            value=f"{(last_msg.content or 'N/A')[:100]}\n\n{format_time_in_timezones(last_msg.timestamp)}",
             inline=False
         )
     
-    total = user_data.get('total_online_seconds', 0)
-    daily = user_data.get('daily_seconds', 0)
-    weekly = user_data.get('weekly_seconds', 0)
-    monthly = user_data.get('monthly_seconds', 0)
+    total = record.total_online_seconds
+    daily = get_period_seconds(record, 'daily', now)
+    weekly = get_period_seconds(record, 'weekly', now)
+    monthly = get_period_seconds(record, 'monthly', now)
     
     embed.add_field(name="📊 Total Time Online (All Time)", value=format_duration(total), inline=False)
     embed.add_field(name="📅 Today", value=format_duration(daily), inline=True)
     embed.add_field(name="📆 This Week", value=format_duration(weekly), inline=True)
     embed.add_field(name="📈 This Month", value=format_duration(monthly), inline=True)
     
-    next_resets = get_next_reset_times(user_data)
+    next_resets = get_next_reset_times(record)
     reset_info = []
     for period, reset_time in next_resets.items():
         time_until = reset_time - now
@@ -751,6 +3782,52 @@ async def timetrack(ctx, member: discord.Member = None):
     
     embed.add_field(name="🔄 Next Resets In", value="\n".join(reset_info), inline=False)
     
+    if lookback_seconds:
+        start = now - timedelta(seconds=lookback_seconds)
+        history = state.data['activity']
+        lines = []
+        if lookback_seconds > 86400:
+            for day, minutes in history.daily_totals(member.id, start, now)[-HISTORY_MAX_DAYS_SHOWN:]:
+                lines.append(f"**{day.isoformat()}:** {format_duration(minutes * 60)}")
+        total_minutes = history.minutes_between(member.id, start, now)
+        lines.append(f"**Total:** {format_duration(total_minutes * 60)}")
+        embed.add_field(name=f"📜 Online In The Last {lookback}", value="\n".join(lines), inline=False)
+    
+    await ctx.send(embed=embed)
+
+@bot.command(name='twho')
+async def twho(ctx, date: str, start: str = '00:00', end: str = None):
+    """Who was online on a UTC date, optionally between two HH:MM times"""
+    if not has_mod_role(ctx.author):
+        return
+    
+    try:
+        start_dt = datetime.strptime(f"{date} {start}", '%Y-%m-%d %H:%M').replace(tzinfo=pytz.utc)
+        if end:
+            end_dt = datetime.strptime(f"{date} {end}", '%Y-%m-%d %H:%M').replace(tzinfo=pytz.utc)
+        else:
+            end_dt = start_dt.replace(hour=0, minute=0) + timedelta(days=1)
+    except ValueError:
+        await ctx.send("❌ Invalid date/time! Use format like: !twho 2024-05-01 02:00 04:00")
+        return
+    if end_dt <= start_dt:
+        await ctx.send("❌ End time must be after the start time!")
+        return
+    
+    state = await guild_states.get(ctx.guild)
+    online = state.data['activity'].online_between(start_dt, end_dt)
+    embed = discord.Embed(
+        title="👥 Who Was Online",
+        description=f"{start_dt.strftime('%Y-%m-%d %H:%M')} - {end_dt.strftime('%Y-%m-%d %H:%M')} UTC",
+        color=discord.Color.blue(),
+        timestamp=datetime.now(pytz.utc)
+    )
+    if online:
+        lines = [f"<@{user_id}> - {format_duration(minutes * 60)}" for user_id, minutes in online[:20]]
+        embed.add_field(name=f"Online ({len(online)})", value="\n".join(lines), inline=False)
+    else:
+        embed.add_field(name="Online (0)", value="Nobody was online", inline=False)
+    
     await ctx.send(embed=embed)
 
 @bot.command(name='rmute')
@@ -763,7 +3840,8 @@ async def rmute(ctx, members: commands.Greedy[discord.Member], duration: str, *,
     if not members:
         return
     
-    mute_role = ctx.guild.get_role(MUTE_ROLE_ID)
+    state = await guild_states.get(ctx.guild)
+    mute_role = ctx.guild.get_role(state.config.mute_role_id)
     if not mute_role:
         return
     
@@ -771,129 +3849,20 @@ async def rmute(ctx, members: commands.Greedy[discord.Member], duration: str, *,
     if duration_seconds == 0:
         return
     
-    tracking_channel = bot.get_channel(MUTE_LOG_CHANNEL_ID)
-    unmute_time = datetime.now(pytz.utc) + timedelta(seconds=duration_seconds)
-    
-    mod_id_str = str(ctx.author.id)
-    bot_data['rmute_usage'][mod_id_str] = bot_data['rmute_usage'].get(mod_id_str, 0) + len(members)
-    
-    for member in members:
-        await member.add_roles(mute_role, reason=reason)
-        
-        try:
-            await member.timeout(timedelta(seconds=duration_seconds), reason=reason)
-        except:
-            pass
-        
-        bot_data['mutes'][str(member.id)] = {
-            'moderator_id': ctx.author.id,
-            'reason': reason,
-            'duration': duration_seconds,
-            'start_time': datetime.now(pytz.utc).isoformat(),
-            'unmute_time': unmute_time.isoformat()
-        }
-        
-        if mod_id_str not in bot_data['mute_history']:
-            bot_data['mute_history'][mod_id_str] = []
-        
-        bot_data['mute_history'][mod_id_str].append({
-            'user_id': member.id,
-            'user_name': str(member),
-            'reason': reason,
-            'duration': duration_seconds,
-            'timestamp': datetime.now(pytz.utc).isoformat()
-        })
-        
-        user_id_str = str(member.id)
-        if user_id_str not in bot_data['user_mute_history']:
-            bot_data['user_mute_history'][user_id_str] = []
-        
-        bot_data['user_mute_history'][user_id_str].append({
-            'reason': reason,
-            'duration': duration_seconds,
-            'timestamp': datetime.now(pytz.utc).isoformat(),
-            'moderator_id': ctx.author.id
-        })
-        
-        dm_embed = discord.Embed(
-            title="🔇 You Have Been Muted",
-            description=f"You have been muted in **{ctx.guild.name}**",
-            color=discord.Color.red(),
-            timestamp=datetime.now(pytz.utc)
-        )
-        dm_embed.add_field(name="⚠️ Reason", value=reason, inline=False)
-        dm_embed.add_field(name="⏱️ Duration", value=format_duration(duration_seconds), inline=True)
-        dm_embed.add_field(name="🕐 Unmute Time", value=format_time_in_timezones(unmute_time), inline=False)
-        dm_embed.set_footer(text="Please follow the server rules.")
-        
-        await send_dm_safe(member, dm_embed)
-        
-        if tracking_channel:
-            log_embed = discord.Embed(
-                title="🔨 User Muted",
-                color=discord.Color.red(),
-                timestamp=datetime.now(pytz.utc)
-            )
-            log_embed.set_thumbnail(url=member.display_avatar.url)
-            log_embed.add_field(name="👤 User", value=f"{member.mention} ({member})", inline=False)
-            log_embed.add_field(name="👮 Moderator", value=ctx.author.mention, inline=False)
-            log_embed.add_field(name="⚠️ Reason", value=reason, inline=False)
-            log_embed.add_field(name="⏱️ Duration", value=format_duration(duration_seconds), inline=True)
-            log_embed.add_field(name="🕐 Unmute Time", value=format_time_in_timezones(unmute_time), inline=False)
-            
-            await tracking_channel.send(embed=log_embed)
-        
-        asyncio.create_task(auto_unmute(member, duration_seconds, reason, ctx.author))
-    
-    save_data()
-
-async def auto_unmute(member: discord.Member, duration: int, original_reason: str, moderator: discord.Member):
-    await asyncio.sleep(duration)
+    results = await mute_members(state, members, ctx.author, duration_seconds, reason)
     
-    mute_role = member.guild.get_role(MUTE_ROLE_ID)
-    if mute_role and mute_role in member.roles:
-        await member.remove_roles(mute_role, reason="Auto-unmute")
-        
-        try:
-            await member.timeout(None, reason="Auto-unmute")
-        except:
-            pass
-        
-        if str(member.id) in bot_data['mutes']:
-            del bot_data['mutes'][str(member.id)]
-            save_data()
-        
-        dm_embed = discord.Embed(
-            title="🔓 You Have Been Unmuted",
-            description=f"Your mute in **{member.guild.name}** has expired",
-            color=discord.Color.green(),
-            timestamp=datetime.now(pytz.utc)
-        )
-        dm_embed.add_field(name="Original Reason", value=original_reason, inline=False)
-        dm_embed.set_footer(text="Remember to follow server rules.")
-        
-        await send_dm_safe(member, dm_embed)
-        
-        tracking_channel = member.guild.get_channel(MUTE_LOG_CHANNEL_ID)
-        if tracking_channel:
-            embed = discord.Embed(
-                title="🔓 Auto-Unmute",
-                description=f"{member.mention} has been automatically unmuted",
-                color=discord.Color.green(),
-                timestamp=datetime.now(pytz.utc)
-            )
-            embed.add_field(name="Original Reason", value=original_reason, inline=False)
-            embed.add_field(name="Muted By", value=moderator.mention, inline=True)
-            embed.add_field(name="Duration", value=format_duration(duration), inline=True)
-            
-            await tracking_channel.send(embed=embed)
+    failed = [result for result in results if result['error'] is not None]
+    if failed:
+        lines = [f"{result['member'].mention}: {result['error']}" for result in failed]
+        await ctx.send(f"❌ Failed to mute {len(failed)}/{len(results)}:\n" + "\n".join(lines)[:1900], delete_after=30)
 
 @bot.command(name='runmute')
 async def runmute(ctx, member: discord.Member, *, reason: str):
     if not has_mod_role(ctx.author):
         return
     
-    mute_role = ctx.guild.get_role(MUTE_ROLE_ID)
+    state = await guild_states.get(ctx.guild)
+    mute_role = ctx.guild.get_role(state.config.mute_role_id)
     
     is_muted = (mute_role and mute_role in member.roles) or (member.timed_out_until and member.timed_out_until > datetime.now(pytz.utc))
     
@@ -901,7 +3870,7 @@ async def runmute(ctx, member: discord.Member, *, reason: str):
         await ctx.send("❌ This user is not muted.")
         return
     
-    mute_data = bot_data['mutes'].get(str(member.id), {})
+    mute_data = state.data['mutes'].get(str(member.id), {})
     
     if mute_role and mute_role in member.roles:
         await member.remove_roles(mute_role, reason=reason)
@@ -912,12 +3881,11 @@ async def runmute(ctx, member: discord.Member, *, reason: str):
         pass
     
     if mute_data.get('start_time'):
-        start = datetime.fromisoformat(mute_data['start_time'])
-        duration = int((datetime.now(pytz.utc) - start).total_seconds())
+        duration = int(time.time()) - mute_data['start_time']
     else:
         duration = 0
     
-    tracking_channel = bot.get_channel(MUTE_LOG_CHANNEL_ID)
+    tracking_channel = bot.get_channel(state.config.mute_log_channel_id)
     if tracking_channel:
         embed = discord.Embed(
             title="🔓 User Unmuted",
@@ -947,114 +3915,182 @@ async def runmute(ctx, member: discord.Member, *, reason: str):
     )
     dm_embed.add_field(name="Reason", value=reason, inline=False)
     
-    await send_dm_safe(member, dm_embed)
+    await send_dm_safe(state, member, dm_embed)
     
-    if str(member.id) in bot_data['mutes']:
-        del bot_data['mutes'][str(member.id)]
-        save_data()
+    if str(member.id) in state.data['mutes']:
+        del state.data['mutes'][str(member.id)]
+        state.mark_dirty('mutes', str(member.id))
+    state.unmutes.cancel(member.id)
     
     await ctx.send(f"✅ {member.mention} has been unmuted.")
 
 @bot.command(name='rmlb')
-async def rmlb(ctx):
+async def rmlb(ctx, page: int = 1):
     if not has_mod_role(ctx.author):
         return
     
-    if not bot_data['rmute_usage']:
+    board = (await guild_states.get(ctx.guild)).leaderboards.rmute
+    if not len(board):
         await ctx.send("❌ No mute usage data available.")
         return
     
-    sorted_usage = sorted(bot_data['rmute_usage'].items(), key=lambda x: x[1], reverse=True)[:10]
+    pages = max(1, -(-len(board) // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    rows = board.page(page)
     
     embed = discord.Embed(
         title="🏆 RMute Usage Leaderboard",
-        description="Top 10 moderators by mute count",
+        description="Top moderators by mute count",
         color=discord.Color.gold(),
         timestamp=datetime.now(pytz.utc)
     )
     
-    for i, (user_id, count) in enumerate(sorted_usage, 1):
-        user = await bot.fetch_user(int(user_id))
+    users = await user_resolver.fetch_many([user_id for user_id, _ in rows], ctx.guild)
+    
+    rank = (page - 1) * LEADERBOARD_PAGE_SIZE
+    for i, (user_id, count) in enumerate(rows, rank + 1):
+        user = users[user_id]
         embed.add_field(
-            name=f"#{i} {user.name}",
+            name=f"#{i} {user.name if user else user_id}",
             value=f"🔨 {count} mutes",
             inline=False
         )
     
+    embed.set_footer(text=f"Page {page}/{pages}")
     await ctx.send(embed=embed)
 
+CASE_PAGE_SIZE = 10
+
+def parse_time_filter(key: str, value: str, now: datetime) -> datetime:
+    """A YYYY-MM-DD date (UTC) or a lookback like 7d"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=pytz.utc)
+    except ValueError:
+        seconds = parse_duration(value)
+        if seconds <= 0:
+            raise ValueError(f"Invalid {key} value: {value}")
+        return now - timedelta(seconds=seconds)
+
+def parse_id_filter(key: str, value: str) -> int:
+    """An id or a user/channel mention"""
+    digits = ''.join(char for char in value if char.isdigit())
+    if not digits:
+        raise ValueError(f"Invalid {key}: {value}")
+    return int(digits)
+
+def parse_case_filters(args: tuple) -> dict:
+    """Turn `reason:spam since:7d min:1h page:2` style arguments into query filters"""
+    filters = {'tokens': (), 'page': 1}
+    now = datetime.now(pytz.utc)
+    for arg in args:
+        key, _, value = arg.partition(':')
+        key = key.lower()
+        if not value and key.isdigit():
+            filters['page'] = int(key)
+        elif key == 'reason':
+            filters['tokens'] += tuple(reason_tokens(value))
+        elif key in ('since', 'until'):
+            filters[key] = parse_time_filter(key, value, now)
+        elif key in ('min', 'max'):
+            seconds = parse_duration(value)
+            if seconds <= 0:
+                raise ValueError(f"Invalid {key} duration: {value}")
+            filters[f'{key}_duration'] = seconds
+        elif key == 'user':
+            filters['user_id'] = parse_id_filter(key, value)
+        elif key == 'page' and value.isdigit():
+            filters['page'] = int(value)
+        else:
+            raise ValueError(f"Unknown filter: {arg}")
+    filters['page'] = max(filters['page'], 1)
+    return filters
+
+async def query_case_page(state, filters: dict):
+    """(total, cases, page, pages) for parsed filters, newest case first"""
+    page = filters.pop('page')
+    await state.sync()
+    total, cases = state.storage.query_cases(state.data, offset=(page - 1) * CASE_PAGE_SIZE, limit=CASE_PAGE_SIZE, **filters)
+    pages = max(1, -(-total // CASE_PAGE_SIZE))
+    return total, cases, page, pages
+
+def case_field_value(case: Case) -> str:
+    mute_time = datetime.fromtimestamp(case.timestamp, pytz.utc)
+    field_value = f"**Reason:** {case.reason}\n"
+    field_value += f"**Duration:** {format_duration(case.duration or 0)}\n"
+    field_value += f"**Time:** {mute_time.strftime('%Y-%m-%d %H:%M UTC')}"
+    return field_value
+
 @bot.command(name='rmal')
-async def rmal(ctx, moderator: discord.Member = None):
+async def rmal(ctx, moderator: Optional[discord.Member] = None, *args):
     if not has_mod_role(ctx.author):
         return
     
     if moderator is None:
         moderator = ctx.author
     
-    mod_id_str = str(moderator.id)
-    mute_history = bot_data['mute_history'].get(mod_id_str, [])
+    try:
+        filters = parse_case_filters(args)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+    state = await guild_states.get(ctx.guild)
+    total_mutes, cases, page, pages = await query_case_page(state, {**filters, 'moderator_id': moderator.id})
     
-    if not mute_history:
+    if not cases:
         await ctx.send(f"❌ No mute history found for {moderator.mention}")
         return
     
     embed = discord.Embed(
         title=f"📋 Mute Action List for {moderator.display_name}",
-        description=f"Total mutes: {len(mute_history)}",
+        description=f"Total mutes: {total_mutes}",
         color=discord.Color.blue(),
         timestamp=datetime.now(pytz.utc)
     )
     embed.set_thumbnail(url=moderator.display_avatar.url)
     
-    for mute in mute_history[-10:]:
-        mute_time = datetime.fromisoformat(mute['timestamp'])
-        field_value = f"**Reason:** {mute['reason']}\n"
-        field_value += f"**Duration:** {format_duration(mute['duration'])}\n"
-        field_value += f"**Time:** {mute_time.strftime('%Y-%m-%d %H:%M UTC')}"
-        
+    for case in cases:
         embed.add_field(
-            name=f"User: {mute['user_name']}",
-            value=field_value,
+            name=f"Case #{case.id} - User: {case.user_name or case.user_id}",
+            value=case_field_value(case),
             inline=False
         )
     
-    if len(mute_history) > 10:
-        embed.set_footer(text=f"Showing last 10 of {len(mute_history)} total mutes")
-    
+    embed.set_footer(text=f"Page {page}/{pages} - newest first")
     await ctx.send(embed=embed)
 
 @bot.command(name='rml')
-async def rml(ctx):
-    user_id_str = str(ctx.author.id)
-    mute_history = bot_data['user_mute_history'].get(user_id_str, [])
+async def rml(ctx, *args):
+    try:
+        filters = parse_case_filters(args)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+    filters.pop('user_id', None)
+    state = await guild_states.get(ctx.guild)
+    if state is None:
+        return
+    total_mutes, cases, page, pages = await query_case_page(state, {**filters, 'user_id': ctx.author.id})
     
-    if not mute_history:
+    if not cases:
         await ctx.send("✅ You have no mute history!")
         return
     
     embed = discord.Embed(
         title=f"📋 Your Mute History",
-        description=f"Total mutes: {len(mute_history)}",
+        description=f"Total mutes: {total_mutes}",
         color=discord.Color.orange(),
         timestamp=datetime.now(pytz.utc)
     )
     embed.set_thumbnail(url=ctx.author.display_avatar.url)
     
-    for mute in mute_history[-10:]:
-        mute_time = datetime.fromisoformat(mute['timestamp'])
-        field_value = f"**Reason:** {mute['reason']}\n"
-        field_value += f"**Duration:** {format_duration(mute['duration'])}\n"
-        field_value += f"**Time:** {mute_time.strftime('%Y-%m-%d %H:%M UTC')}"
-        
+    for case in cases:
         embed.add_field(
-            name=f"Mute #{mute_history.index(mute) + 1}",
-            value=field_value,
+            name=f"Case #{case.id}",
+            value=case_field_value(case),
             inline=False
         )
     
-    if len(mute_history) > 10:
-        embed.set_footer(text=f"Showing last 10 of {len(mute_history)} total mutes")
-    
+    embed.set_footer(text=f"Page {page}/{pages} - newest first")
     await ctx.send(embed=embed)
 
 @bot.command(name='rcache')
@@ -1062,11 +4098,12 @@ async def rcache(ctx):
     if not has_mod_role(ctx.author):
         return
     
-    if not bot_data['cached_messages']:
+    cache = (await guild_states.get(ctx.guild)).data['cached_messages']
+    if not cache:
         await ctx.send("❌ No cached messages available.")
         return
     
-    recent_messages = bot_data['cached_messages'][-10:]
+    recent_messages = cache.recent(10)
     
     embed = discord.Embed(
         title="🗂️ Recent Cached Messages",
@@ -1074,116 +4111,179 @@ async def rcache(ctx):
         timestamp=datetime.now(pytz.utc)
     )
     
+    authors = await user_resolver.fetch_many([msg.author_id for msg in recent_messages], ctx.guild)
+    
     for msg in recent_messages:
-        try:
-            author = await bot.fetch_user(msg['author_id'])
+        author = authors[msg.author_id]
+        if author:
             field_value = f"**Author:** {author.mention}\n"
-        except:
-            field_value = f"**Author:** {msg.get('author_name', 'Unknown')}\n"
+        else:
+            field_value = f"**Author:** {msg.author_name or 'Unknown'}\n"
         
-        if msg.get('content'):
-            field_value += f"**Content:** {msg['content'][:100]}\n"
+        if msg.content:
+            field_value += f"**Content:** {msg.content[:100]}\n"
         
-        if msg.get('attachments'):
-            field_value += f"**Attachments:** {', '.join(msg['attachments'][:3])}\n"
+        if msg.attachments:
+            field_value += f"**Attachments:** {', '.join(msg.attachments[:3])}\n"
         
-        if msg.get('reference'):
-            field_value += f"**Reply to:** Message ID {msg['reference']}\n"
+        if msg.reference:
+            field_value += f"**Reply to:** Message ID {msg.reference}\n"
         
-        if msg.get('created_at'):
-            created = datetime.fromisoformat(msg['created_at'])
-            age = datetime.now(pytz.utc) - created.replace(tzinfo=pytz.utc)
-            field_value += f"**Age:** {format_duration(int(age.total_seconds()))}\n"
+        if msg.created_at:
+            field_value += f"**Age:** {format_duration(int(time.time()) - msg.created_at)}\n"
         
-        embed.add_field(name=f"Message {msg['id']}", value=field_value[:1024], inline=False)
+        embed.add_field(name=f"Message {msg.id}", value=field_value[:1024], inline=False)
     
     await ctx.send(embed=embed)
 
-@bot.command(name='tlb')
-async def tlb(ctx):
+SEARCH_RESULT_LIMIT = 10
+
+@bot.command(name='rsearch')
+async def rsearch(ctx, *args):
     if not has_mod_role(ctx.author):
         return
     
-    guild = ctx.guild
-    tracked_users = []
+    terms = []
+    filters = {}
+    now = datetime.now(pytz.utc)
+    try:
+        for arg in args:
+            key, _, value = arg.partition(':')
+            key = key.lower()
+            if value and key == 'author':
+                filters['author_id'] = parse_id_filter(key, value)
+            elif value and key == 'channel':
+                filters['channel_id'] = parse_id_filter(key, value)
+            elif value and key == 'since':
+                filters['after'] = parse_time_filter(key, value, now)
+            elif value and key == 'until':
+                filters['before'] = parse_time_filter(key, value, now)
+            else:
+                terms.append(arg)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
     
-    for user_id, user_data in bot_data['users'].items():
-        member = guild.get_member(int(user_id))
-        if member and any(role.id in RCACHE_ROLES for role in member.roles):
-            daily_avg = user_data.get('daily_seconds', 0)
-            tracked_users.append((member, daily_avg))
+    if not terms:
+        await ctx.send("❌ Usage: !rsearch <words> [author:@user] [channel:#channel] [since:1h] [until:2024-01-31]")
+        return
     
-    tracked_users.sort(key=lambda x: x[1], reverse=True)
-    tracked_users = tracked_users[:10]
+    query = " ".join(terms)
+    state = await guild_states.get(ctx.guild)
+    total, matches = state.data['cached_messages'].search(query, limit=SEARCH_RESULT_LIMIT, **filters)
     
     embed = discord.Embed(
-        title="🏆 Timetrack Leaderboard (Tracked Roles)",
-        description="Top 10 users by daily online time",
+        title="🔎 Message Cache Search",
+        description=f"{total} cached messages match `{query[:100]}`",
         color=discord.Color.blue(),
-        timestamp=datetime.now(pytz.utc)
+        timestamp=now
     )
     
-    for i, (member, seconds) in enumerate(tracked_users, 1):
-        embed.add_field(
-            name=f"#{i} {member.display_name}",
-            value=f"⏰ {format_duration(seconds)} today",
-            inline=False
-        )
-    
-    if not tracked_users:
-        embed.description = "No tracked users found."
+    for msg in matches:
+        field_value = f"**Author:** <@{msg.author_id}> ({msg.author_name or 'Unknown'})\n"
+        field_value += f"**Channel:** <#{msg.channel_id}>\n"
+        if msg.content:
+            field_value += f"**Content:** {msg.content[:300]}\n"
+        if msg.attachments:
+            field_value += f"**Attachments:** {', '.join(msg.attachments[:3])}\n"
+        if msg.created_at:
+            created = datetime.fromtimestamp(msg.created_at, pytz.utc)
+            field_value += f"**Sent:** {created.strftime('%Y-%m-%d %H:%M UTC')}\n"
+        embed.add_field(name=f"Message {msg.id}", value=field_value[:1024], inline=False)
+    
+    if total > len(matches):
+        embed.set_footer(text=f"Showing newest {len(matches)} of {total}")
     
     await ctx.send(embed=embed)
 
-@bot.command(name='tdm')
-async def tdm(ctx):
+@bot.command(name='rtraces')
+async def rtraces(ctx, limit: int = 5):
     if not has_mod_role(ctx.author):
         return
     
-    guild = ctx.guild
-    untracked_users = []
+    traces = list(reversed(slow_traces))[:max(1, min(limit, 10))]
+    embed = discord.Embed(
+        title="🐢 Slow Handler Traces",
+        description=f"Handlers slower than {SLOW_HANDLER_SECONDS}s, newest first",
+        color=discord.Color.orange(),
+        timestamp=datetime.now(pytz.utc)
+    )
+    
+    for trace in traces:
+        field_value = f"**Wall:** {trace['wall']}s | **REST:** {trace['rest']}s | **Sync:** {trace['sync']}s\n"
+        slowest = sorted(trace['calls'], key=lambda call: call[1], reverse=True)[:3]
+        for route, seconds in slowest:
+            field_value += f"`{route}` {seconds}s\n"
+        at = datetime.fromisoformat(trace['at'])
+        embed.add_field(name=f"{trace['handler']} @ {at.strftime('%H:%M:%S UTC')}", value=field_value[:1024], inline=False)
+    
+    if not traces:
+        embed.description = "No slow handlers recorded."
     
-    for user_id, user_data in bot_data['users'].items():
-        member = guild.get_member(int(user_id))
-        if member and not any(role.id in RCACHE_ROLES for role in member.roles):
-            daily_avg = user_data.get('daily_seconds', 0)
-            untracked_users.append((member, daily_avg))
+    await ctx.send(embed=embed)
+
+async def send_time_leaderboard(ctx, tracked: bool, window: str, page: int):
+    if window.isdigit():
+        window, page = 'daily', int(window)
+    window = window.lower()
+    if window not in LEADERBOARD_WINDOWS:
+        await ctx.send(f"❌ Unknown window! Use one of: {', '.join(LEADERBOARD_WINDOWS)}")
+        return
     
-    untracked_users.sort(key=lambda x: x[1], reverse=True)
-    untracked_users = untracked_users[:10]
+    leaderboards = (await guild_states.get(ctx.guild)).leaderboards
+    _, pages = leaderboards.page(window, tracked, 1)
+    page = min(max(page, 1), pages)
+    rows, _ = leaderboards.page(window, tracked, page)
+    label = LEADERBOARD_WINDOWS[window]
     
     embed = discord.Embed(
-        title="🏆 Timetrack Leaderboard (Non-Tracked Roles)",
-        description="Top 10 users by daily online time",
-        color=discord.Color.purple(),
+        title=f"🏆 Timetrack Leaderboard ({'Tracked' if tracked else 'Non-Tracked'} Roles)",
+        description=f"Top users by online time {label}",
+        color=discord.Color.blue() if tracked else discord.Color.purple(),
         timestamp=datetime.now(pytz.utc)
     )
     
-    for i, (member, seconds) in enumerate(untracked_users, 1):
+    rank = (page - 1) * LEADERBOARD_PAGE_SIZE
+    for i, (user_id, seconds) in enumerate(rows, rank + 1):
+        member = ctx.guild.get_member(user_id)
         embed.add_field(
-            name=f"#{i} {member.display_name}",
-            value=f"⏰ {format_duration(seconds)} today",
+            name=f"#{i} {member.display_name if member else user_id}",
+            value=f"⏰ {format_duration(seconds)} {label}",
             inline=False
         )
     
-    if not untracked_users:
-        embed.description = "No untracked users found."
+    if not rows:
+        embed.description = "No tracked users found." if tracked else "No untracked users found."
     
+    embed.set_footer(text=f"Page {page}/{pages}")
     await ctx.send(embed=embed)
 
+@bot.command(name='tlb')
+async def tlb(ctx, window: str = 'daily', page: int = 1):
+    if not has_mod_role(ctx.author):
+        return
+    await send_time_leaderboard(ctx, True, window, page)
+
+@bot.command(name='tdm')
+async def tdm(ctx, window: str = 'daily', page: int = 1):
+    if not has_mod_role(ctx.author):
+        return
+    await send_time_leaderboard(ctx, False, window, page)
+
 @bot.command(name='sping')
 async def sping(ctx):
     # Removed the moderator check - anyone can use this now
     
     await ctx.message.delete()
     
-    staff_role = ctx.guild.get_role(STAFF_PING_ROLE)
+    config = guild_config(ctx.guild)
+    staff_role = ctx.guild.get_role(config.staff_ping_role) if config else None
     if not staff_role:
         return
     
     log_channels = [
-        bot.get_channel(TRACKING_CHANNEL_ID),
-        bot.get_channel(MUTE_LOG_CHANNEL_ID)
+        bot.get_channel(config.tracking_channel_id),
+        bot.get_channel(config.mute_log_channel_id)
     ]
     
     reply_info = None
@@ -1200,22 +4300,20 @@ async def sping(ctx):
     
     await ctx.send(f"{staff_role.mention}")
     
-    for log_channel in log_channels:
-        if log_channel:
-            embed = discord.Embed(
-                title="📢 Staff Ping",
-                color=discord.Color.blue(),
-                timestamp=datetime.now(pytz.utc)
-            )
-            embed.add_field(name="Pinged By", value=ctx.author.mention, inline=False)
-            embed.add_field(name="Channel", value=ctx.channel.mention, inline=False)
-            
-            if reply_info:
-                embed.add_field(name="Reply To", value=reply_info['author'].mention, inline=False)
-                embed.add_field(name="Original Message", value=reply_info['content'], inline=False)
-                embed.add_field(name="Jump to Message", value=f"[Click Here]({reply_info['jump_url']})", inline=False)
-            
-            await log_channel.send(embed=embed)
+    embed = discord.Embed(
+        title="📢 Staff Ping",
+        color=discord.Color.blue(),
+        timestamp=datetime.now(pytz.utc)
+    )
+    embed.add_field(name="Pinged By", value=ctx.author.mention, inline=False)
+    embed.add_field(name="Channel", value=ctx.channel.mention, inline=False)
+    
+    if reply_info:
+        embed.add_field(name="Reply To", value=reply_info['author'].mention, inline=False)
+        embed.add_field(name="Original Message", value=reply_info['content'], inline=False)
+        embed.add_field(name="Jump to Message", value=f"[Click Here]({reply_info['jump_url']})", inline=False)
+    
+    await broadcaster.send(log_channels, embed=embed)
 
 @bot.command(name='hsping')
 async def hsping(ctx):
@@ -1223,13 +4321,14 @@ async def hsping(ctx):
     
     await ctx.message.delete()
     
-    higher_staff_role = ctx.guild.get_role(HIGHER_STAFF_PING_ROLE)
+    config = guild_config(ctx.guild)
+    higher_staff_role = ctx.guild.get_role(config.higher_staff_ping_role) if config else None
     if not higher_staff_role:
         return
     
     log_channels = [
-        bot.get_channel(TRACKING_CHANNEL_ID),
-        bot.get_channel(MUTE_LOG_CHANNEL_ID)
+        bot.get_channel(config.tracking_channel_id),
+        bot.get_channel(config.mute_log_channel_id)
     ]
     
     reply_info = None
@@ -1246,42 +4345,50 @@ async def hsping(ctx):
     
     await ctx.send(f"{higher_staff_role.mention}")
     
-    for log_channel in log_channels:
-        if log_channel:
-            embed = discord.Embed(
-                title="🚨 Higher Staff Ping",
-                color=discord.Color.red(),
-                timestamp=datetime.now(pytz.utc)
-            )
-            embed.add_field(name="Pinged By", value=ctx.author.mention, inline=False)
-            embed.add_field(name="Channel", value=ctx.channel.mention, inline=False)
-            
-            if reply_info:
-                embed.add_field(name="Reply To", value=reply_info['author'].mention, inline=False)
-                embed.add_field(name="Original Message", value=reply_info['content'], inline=False)
-                embed.add_field(name="Jump to Message", value=f"[Click Here]({reply_info['jump_url']})", inline=False)
-            
-            await log_channel.send(embed=embed)
+    embed = discord.Embed(
+        title="🚨 Higher Staff Ping",
+        color=discord.Color.red(),
+        timestamp=datetime.now(pytz.utc)
+    )
+    embed.add_field(name="Pinged By", value=ctx.author.mention, inline=False)
+    embed.add_field(name="Channel", value=ctx.channel.mention, inline=False)
+    
+    if reply_info:
+        embed.add_field(name="Reply To", value=reply_info['author'].mention, inline=False)
+        embed.add_field(name="Original Message", value=reply_info['content'], inline=False)
+        embed.add_field(name="Jump to Message", value=f"[Click Here]({reply_info['jump_url']})", inline=False)
+    
+    await broadcaster.send(log_channels, embed=embed)
 
 @bot.command(name='rdm')
 async def rdm(ctx):
     user_id_str = str(ctx.author.id)
+    state = await guild_states.get(ctx.guild)
+    if state is None:
+        return
     
-    if user_id_str in bot_data['rdm_users']:
-        bot_data['rdm_users'].remove(user_id_str)
-        save_data()
+    if user_id_str in state.data['rdm_users']:
+        state.data['rdm_users'].remove(user_id_str)
+        state.mark_dirty('rdm_users', user_id_str)
         await ctx.send("✅ You will now receive DM notifications from the bot.")
     else:
-        bot_data['rdm_users'].append(user_id_str)
-        save_data()
+        state.data['rdm_users'].append(user_id_str)
+        state.mark_dirty('rdm_users', user_id_str)
         await ctx.send("✅ You have opted out of DM notifications from the bot.")
 
 # Run the bot
 if __name__ == "__main__":
+    if '--bench' in sys.argv:
+        benchmark_user_records()
+        exit(0)
+    
     TOKEN = os.getenv('DISCORD_TOKEN')
     if not TOKEN:
         print("❌ Error: DISCORD_TOKEN environment variable not set!")
         exit(1)
+    if SHARD_IDS and SHARD_COUNT is None:
+        print("❌ Error: SHARD_IDS needs a numeric SHARD_COUNT!")
+        exit(1)
     
-    keep_alive()
     bot.run(TOKEN)
+    save_data()